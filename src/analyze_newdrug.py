@@ -4,7 +4,7 @@ Run the analysis of the TRISTAN project on a new drug.
 
 import os
 
-from methods import report, master_primary
+from methods import report, master_primary, cli
 
 
 def main():
@@ -29,5 +29,6 @@ def main():
 
 
 if __name__ == '__main__':
+    cli.parse_args()
     main()
 
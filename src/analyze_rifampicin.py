@@ -1,9 +1,6 @@
 import os
-import shutil
 
-import miblab
-
-from methods import report, master_primary
+from methods import report, master_primary, datastore, cli
 
 
 def main():
@@ -13,10 +10,9 @@ def main():
 
     # Define folders
     results = os.path.join(os.getcwd(), 'build', drug)
-    datapath = os.path.join(os.getcwd(), 'data')
     
     # Get the data
-    data = miblab.zenodo_fetch(dataset, datapath)
+    data = datastore.fetch(dataset)
 
     # Compute results
     master_primary.run(data, results)
@@ -30,10 +26,8 @@ def main():
         subject = 'Internal report',
     )
 
-    # Cleanup temporary folder
-    shutil.rmtree(datapath)
-
 
 if __name__ == '__main__':
+    cli.parse_args()
     main()
 
@@ -0,0 +1,96 @@
+"""
+Benchmark the derivation of effect sizes in methods.calc on synthetic
+cohorts, up to 1000 subjects x 60 parameters x 8 acquisition times.
+
+    python src/benchmark_calc.py [--subjects 10 100 1000] [--parameters 60]
+
+The results are checked against a direct per-subject computation on
+the smallest cohort.
+"""
+
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from methods import calc
+
+
+ACQ_TIMES = [5, 10, 15, 20, 25, 30, 35, 40]
+
+
+def cohort(n_subjects, n_parameters, acq_times=None, unpaired=0.05, seed=0):
+    # Results in the format of the results store, with a fraction of
+    # subjects that only have a control visit.
+    rng = np.random.default_rng(seed)
+    subjects = [str(i).zfill(4) for i in range(n_subjects)]
+    single = rng.random(n_subjects) < unpaired
+    if acq_times is None:
+        studies = [('control', 'drug')]
+    else:
+        studies = [('control_' + str(t).zfill(2), 'drug_' + str(t).zfill(2))
+                   for t in acq_times]
+    parameters = ['p' + str(i) for i in range(n_parameters)]
+    subject, visit, parameter = [], [], []
+    for i, subj in enumerate(subjects):
+        for v in range(1 if single[i] else 2):
+            for study in studies:
+                subject += [subj]*n_parameters
+                visit += [study[v]]*n_parameters
+                parameter += parameters
+    return pd.DataFrame({
+        'subject': subject,
+        'visit': visit,
+        'parameter': parameter,
+        'value': rng.uniform(1, 10, len(subject)),
+    })
+
+
+def _reference(output):
+    # Percentage change for each subject and parameter, one at a time
+    effect = {}
+    for (subj, par), df in output.groupby(['subject', 'parameter']):
+        if len(df) == 2:
+            v = df.set_index('visit').value
+            effect[subj, par] = 100*(v['drug'] - v['control'])/v['control']
+    return effect
+
+
+def check(n_parameters):
+    output = cohort(20, n_parameters)
+    ref = _reference(output)
+    effect = calc._derive_effect_sizes(output)
+    assert len(effect) == len(ref)
+    for row in effect.itertuples(index=False):
+        assert np.isclose(row.value, ref[row.subject, row.parameter])
+    print('Check: OK')
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--subjects', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    parser.add_argument('--parameters', type=int, default=60)
+    args = parser.parse_args(argv)
+
+    check(args.parameters)
+
+    print(f"{'Subjects':>10}{'Rows':>12}{'Effect (sec)':>15}"
+          f"{'Rows':>12}{'Vart (sec)':>15}")
+    for n in args.subjects:
+        output = cohort(n, args.parameters)
+        start = time.time()
+        calc._derive_effect_sizes(output)
+        t = time.time() - start
+        vart = cohort(n, args.parameters, acq_times=ACQ_TIMES)
+        start = time.time()
+        calc._derive_vart_effect_sizes(vart)
+        t_vart = time.time() - start
+        print(f'{n:>10}{len(output):>12}{t:>15.3f}{len(vart):>12}'
+              f'{t_vart:>15.3f}')
+
+
+if __name__ == '__main__':
+    main()
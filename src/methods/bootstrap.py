@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# Bootstrap confidence intervals of the mean of many parameters at
+# once. Each draw resamples the subjects with replacement, so that the
+# values of all parameters of a subject stay together. A draw is
+# represented by the number of times each subject is selected, so
+# that the means of all parameters in a chunk of draws are a single
+# matrix product.
+
+# Memory used for the draws of one chunk (bytes)
+CHUNK_MEMORY = 100e6
+
+
+def options(draws=None, seed=None, chunk=None):
+    # Settings not provided are read from the environment variables
+    # TRISTAN_BOOTSTRAP (number of draws, default 0 = no bootstrap),
+    # TRISTAN_BOOTSTRAP_SEED (default 0) and TRISTAN_BOOTSTRAP_CHUNK
+    # (draws per chunk, default set by CHUNK_MEMORY).
+    if draws is None:
+        draws = int(os.environ.get('TRISTAN_BOOTSTRAP', '0') or 0)
+    if seed is None:
+        seed = int(os.environ.get('TRISTAN_BOOTSTRAP_SEED', '0') or 0)
+    if chunk is None:
+        chunk = os.environ.get('TRISTAN_BOOTSTRAP_CHUNK')
+        chunk = None if not chunk else int(chunk)
+    if draws < 0:
+        raise ValueError("The number of bootstrap draws must be positive.")
+    return {'draws': draws, 'seed': seed, 'chunk': chunk}
+
+
+def mean_ci(values, draws=2000, seed=0, chunk=None, confidence=0.95):
+
+    # Percentile bootstrap confidence interval of the mean of each
+    # column of values (subjects x parameters). Missing values (NaN)
+    # are left out of the means of the draws that select them.
+    # Returns the lower and upper limits for each column.
+
+    if draws < 1:
+        raise ValueError(
+            "At least one bootstrap draw is needed for a confidence "
+            "interval."
+        )
+    values = np.asarray(values, dtype=np.float64)
+    n, k = values.shape
+    valid = ~np.isnan(values)
+    x = np.where(valid, values, 0)
+    valid = valid.astype(np.float64)
+    if chunk is None:
+        chunk = int(max(1, CHUNK_MEMORY // (8*(n + 2*k))))
+
+    rng = np.random.default_rng(seed)
+    p = np.full(n, 1/n)
+    means = np.empty((draws, k))
+    for start in range(0, draws, chunk):
+        stop = min(start + chunk, draws)
+        weights = rng.multinomial(n, p, size=stop-start).astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means[start:stop] = (weights @ x) / (weights @ valid)
+
+    # No interval for parameters without values
+    alpha = 100*(1 - confidence)/2
+    low, high = np.full(k, np.nan), np.full(k, np.nan)
+    cols = valid.sum(axis=0) > 0
+    low[cols], high[cols] = np.nanpercentile(
+        means[:, cols], [alpha, 100 - alpha], axis=0)
+    return low, high
+
+
+def effect_ci(effect_size, draws=2000, seed=0, chunk=None):
+
+    # Bootstrap confidence intervals of the mean effect size of each
+    # parameter, from a table with columns subject, parameter and
+    # value as in effect_size.csv. Returns a DataFrame indexed by
+    # parameter with columns low and high.
+
+    matrix = pd.pivot_table(effect_size, values='value', index='subject',
+                            columns='parameter', dropna=False)
+    low, high = mean_ci(matrix.values, draws=draws, seed=seed, chunk=chunk)
+    return pd.DataFrame({'low': low, 'high': high}, index=matrix.columns)
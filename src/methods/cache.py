@@ -0,0 +1,156 @@
+import os
+import pickle
+import hashlib
+from importlib.metadata import version
+
+import numpy as np
+
+
+# Model attributes that are recomputed on demand and not cached
+NOCACHE = ['t', 'ca']
+
+
+def folder():
+    # Location of the cache, set with the environment variable
+    # TRISTAN_CACHE (default build/.cache in the working directory).
+    return os.environ.get(
+        'TRISTAN_CACHE',
+        os.path.join(os.getcwd(), 'build', '.cache'),
+    )
+
+
+def enabled(cache=None):
+    # If cache is not provided, the cache is used unless the
+    # environment variable TRISTAN_NO_CACHE is set.
+    if cache is None:
+        return os.environ.get('TRISTAN_NO_CACHE', '0') in ['', '0']
+    return cache
+
+
+def max_size():
+    # Maximum size of the cache in MB, set with the environment
+    # variable TRISTAN_CACHE_SIZE (default 500).
+    return float(os.environ.get('TRISTAN_CACHE_SIZE', 500))
+
+
+def key(model, xdata, ydata, pars, **kwargs):
+    # Hash of everything that determines the outcome of training:
+    # model type and dcmri version, the data, the parameters used to
+    # build the model, its initial free parameters and any other
+    # settings passed as keyword arguments.
+    h = hashlib.sha256()
+    h.update(type(model).__name__.encode())
+    h.update(version('dcmri').encode())
+    for x in tuple(xdata) + tuple(ydata):
+        x = np.ascontiguousarray(x, dtype=np.float64)
+        h.update(str(x.shape).encode())
+        h.update(x.tobytes())
+    for p in sorted(pars):
+        h.update(f'{p}={pars[p]!r};'.encode())
+    for p in model.free:
+        h.update(f'{p}={getattr(model, p)!r};'.encode())
+    for p in sorted(kwargs):
+        h.update(f'{p}={kwargs[p]!r};'.encode())
+    return h.hexdigest()
+
+
+def load(key):
+    file = os.path.join(folder(), key + '.pkl')
+    try:
+        with open(file, 'rb') as f:
+            state = pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return None
+    # Mark as recently used
+    try:
+        os.utime(file)
+    except FileNotFoundError:
+        pass
+    return state
+
+
+def state(model):
+    # Attributes of a trained model that are needed to restore it
+    return {
+        p: v for p, v in model.__dict__.items()
+        if p not in NOCACHE and not callable(v)
+    }
+
+
+def dump(model, file):
+    # Write to a temporary file first so that concurrent readers
+    # never see a partially written entry.
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    tmp = file + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(state(model), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, file)
+    return file
+
+
+def restore(model, file):
+    # Restore a model saved with dump. model must be built with the
+    # same constructor arguments as the one that was saved.
+    with open(file, 'rb') as f:
+        model.__dict__.update(pickle.load(f))
+    return model
+
+
+def save(key, model):
+    dump(model, os.path.join(folder(), key + '.pkl'))
+    evict()
+
+
+def evict(size=None):
+    # Remove the least recently used entries until the cache is
+    # smaller than size (in MB).
+    if size is None:
+        size = max_size()
+    path = folder()
+    if not os.path.exists(path):
+        return
+    entries = []
+    for file in os.listdir(path):
+        if not file.endswith('.pkl'):
+            continue
+        try:
+            stat = os.stat(os.path.join(path, file))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, file))
+    total = sum(e[1] for e in entries)
+    for _, nbytes, file in sorted(entries):
+        if total <= size*1e6:
+            break
+        try:
+            os.remove(os.path.join(path, file))
+        except FileNotFoundError:
+            pass
+        total -= nbytes
+
+
+def train(model, xdata, ydata, pars, cache=None, verbose=0, tacq=None, 
+          **kwargs):
+    # Train the model, or restore the trained state from the cache if
+    # the same model has been trained on the same data before.
+    # Keyword arguments are passed on to model.train.
+    if not enabled(cache):
+        model.train(xdata, ydata, verbose=verbose, **kwargs)
+        return model
+    k = key(model, xdata, ydata, pars, tacq=tacq, **kwargs)
+    state = load(k)
+    if state is None:
+        model.train(xdata, ydata, verbose=verbose, **kwargs)
+        save(k, model)
+    else:
+        model.__dict__.update(state)
+    return model
+
+
+def purge():
+    path = folder()
+    if not os.path.exists(path):
+        return
+    for file in os.listdir(path):
+        if file.endswith('.pkl') or file.endswith('.tmp'):
+            os.remove(os.path.join(path, file))
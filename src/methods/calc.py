@@ -1,77 +1,76 @@
 import os
+import sys
 import math
 import pandas as pd
 import numpy as np
 import pingouin as pg
-import pydmr
+
+if __name__ == '__main__':
+    # Self-checks at the bottom, run as python src/methods/calc.py
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from methods import store, ttests, bootstrap as boot
+from methods import session as results_session
 
 
 def lookup(path, params, prop): # TODO: dcmri.lookup_dmr()
-    
-    dmr = pydmr.read(os.path.join(path, 'all_results'), format='table')
-    cols = ['parameter', 'description', 'unit', 'type', 'group', 'label']
-    df = pd.DataFrame(dmr['data'], columns=cols)
-    df.set_index('parameter', inplace=True)
-    vals = []
-    for p in params:
-        vals.append(df.at[p, prop])
-        # if ' effect size' in p:
-        #     if prop=='unit':
-        #         vals.append('%')
-        #     else:
-        #         vals.append(df.at[p[:-12], prop])
-        # else:
-        #     vals.append(df.at[p, prop])
-    return vals
+    return store.lookup(path, params, prop)
+
+
+def _percent_change(output, keys):
+    # Percentage change from the first to the second visit for each
+    # combination of keys (e.g. subject and parameter), computed for 
+    # all of them at once. Combinations that do not have exactly one
+    # value for each of the two visits are unpaired and left out. 
+    # Rows are returned in order of first appearance of the keys.
+    visits = output.visit.unique()
+    if len(visits) != 2:
+        return pd.DataFrame(columns=keys + ['value'])
+    group = output.groupby(keys, sort=False).visit
+    paired = (group.transform('size') == 2) & (group.transform('nunique') == 2)
+    unpaired = output[~paired].subject.unique()
+    if len(unpaired) > 0:
+        print('Effect sizes - unpaired values left out for subjects: ', 
+              list(unpaired))
+    output = output[paired]
+    if output.empty:
+        return pd.DataFrame(columns=keys + ['value'])
+    order = pd.MultiIndex.from_frame(output[keys].drop_duplicates())
+    wide = output.pivot(index=keys, columns='visit', values='value')
+    wide = wide.reindex(order)
+    v0 = wide[visits[0]].values
+    v1 = wide[visits[1]].values
+    effect = wide.index.to_frame(index=False)
+    effect['value'] = 100*np.divide(v1-v0, v0)
+    return effect
 
 
 def _derive_effect_sizes(output):
-    effect_size = []
-    for subject in output.subject.unique():
-        df_subj = output[output.subject==subject]
-        for par in df_subj.parameter.unique():
-            df_par = df_subj[df_subj.parameter==par]
-            if len(df_par)==2:
-                visits = df_par.visit.unique()
-                v0 = df_par[df_par.visit==visits[0]].value.values[0]
-                v1 = df_par[df_par.visit==visits[1]].value.values[0]
-                effect = 100*np.divide(v1-v0, v0)
-                effect = [subject, par, effect]
-                effect_size.append(effect)
-    return pd.DataFrame(
-        data=effect_size, 
-        columns=['subject','parameter','value'],
-    )
+    effect_size = _percent_change(output, ['subject', 'parameter'])
+    return effect_size[['subject','parameter','value']]
+
 
 def _derive_vart_effect_sizes(output):
-    effect_size = []
-    for subject in output.subject.unique():
-        df_subj = output[output.subject==subject]
-        tacqs = np.unique([v[-2:] for v in df_subj.visit.values])
-        visits = np.unique([v[:-2] for v in df_subj.visit.values])
-        if len(visits)==2:
-            for tacq in tacqs:
-                df0 = df_subj[df_subj.visit=='control_'+tacq]
-                df1 = df_subj[df_subj.visit=='drug_'+tacq]
-                for par in df0.parameter.unique():
-                    v0 = df0[df0.parameter==par].value.values[0]
-                    v1 = df1[df1.parameter==par].value.values[0]
-                    effect = 100*np.divide(v1-v0, v0)
-                    effect = [subject, par, effect, tacq]
-                    effect_size.append(effect)
-    return pd.DataFrame(
-        data=effect_size, 
-        columns=['subject','parameter','value', 'tacq'],
+    # Visits are labelled <visit>_<tacq> with tacq in 2 digits. There
+    # are only a few distinct labels so these are split only once.
+    codes, labels = pd.factorize(output.visit)
+    output = output.assign(
+        visit = np.array([v[:-2] for v in labels], dtype=object)[codes], 
+        tacq = np.array([v[-2:] for v in labels], dtype=object)[codes],
     )
-
-
-def effect_size(src, ref=False):
-    output_file = os.path.join(src, 'all_results')
-    dmr = pydmr.read(output_file, format='table')
-    cols = ['subject', 'visit', 'parameter', 'value']
-    output = pd.DataFrame(dmr['pars'], columns=cols)
-    stdev = pd.DataFrame(dmr['sdev'], columns=cols)
-    output['stdev'] = stdev.value.values
+    effect_size = _percent_change(output, ['subject', 'tacq', 'parameter'])
+    # Order by subject, then acquisition time
+    subjects = pd.Categorical(
+        effect_size.subject, categories=output.subject.unique())
+    effect_size = effect_size.iloc[
+        np.lexsort((effect_size.tacq.values, subjects.codes))]
+    effect_size.reset_index(drop=True, inplace=True)
+    return effect_size[['subject','parameter','value', 'tacq']]
+
+
+def effect_size(src, ref=False, session=None):
+    session = results_session.get(src, session)
+    output = session.results().rename(columns={'sdev': 'stdev'})
     #
     # Add stdev as a columnn to parameters_rep.csv
     # 
@@ -86,21 +85,17 @@ def effect_size(src, ref=False):
     df = output[output.parameter.isin(todrop)]
     output.drop(index=df.index, inplace=True)
     output.reset_index(drop=True, inplace=True)
-    path = os.path.join(src, 'Analysis')
-    if not os.path.exists(path):
-        os.makedirs(path)
     if ref:
-        output.to_csv(os.path.join(path, 'reference.csv'), index=False)
+        session.save('reference', output, index=False)
     else:
-        output.to_csv(os.path.join(path, 'parameters_rep.csv'), index=False)
+        session.save('parameters_rep', output, index=False)
         effect_size = _derive_effect_sizes(output)
-        effect_size.to_csv(os.path.join(path, 'effect_size.csv'), index=False)
+        session.save('effect_size', effect_size, index=False)
 
 
-def derive_vart_pars(src):
-    output_file = os.path.join(src, 'all_results')
-    dmr = pydmr.read(output_file, format='table')
-    output = pd.DataFrame(dmr['pars'], columns=['subject', 'visit', 'parameter', 'value'])
+def derive_vart_pars(src, session=None):
+    session = results_session.get(src, session)
+    output = session.results().drop(columns='sdev')
     todrop =[
         'BAT','BAT1','BAT2','S02b','S02','Tc'
         'S02l',
@@ -112,20 +107,44 @@ def derive_vart_pars(src):
     df = output[output.parameter.isin(todrop)]
     output.drop(index=df.index, inplace=True)
     output.reset_index(drop=True, inplace=True)
-    path = os.path.join(src, 'Analysis')
-    if not os.path.exists(path):
-        os.makedirs(path)
-    output.to_csv(os.path.join(path, 'parameters_rep.csv'), index=False)
+    session.save('parameters_rep', output, index=False)
     effect_size = _derive_vart_effect_sizes(output)
-    effect_size.to_csv(os.path.join(path, 'effect_size.csv'), index=False)
+    # Acquisition times are integers when read from the csv file
+    session.save('effect_size', effect_size, dtype={'tacq': int}, 
+                 index=False)
     
 
-def descriptive_statistics(src):
-    path = os.path.join(src, 'Analysis')
-    if not os.path.exists(path):
-        os.makedirs(path)
-    output_file = os.path.join(path, 'parameters_rep.csv')
-    output = pd.read_csv(output_file)
+# Parameters of the diurnal variation in liver function: start and end
+# time of the acquisitions, and initial and final rate constants
+DIURNAL = ['t0', 't3', 'khe_i', 'khe_f', 'kbh_i', 'kbh_f']
+
+
+def _diurnal_summary(output):
+    # One row per visit and subject with the parameters in DIURNAL, 
+    # in order of first appearance of the visits and of the subjects
+    # in each visit. Where a parameter appears more than once for the
+    # same subject and visit, the first value is used.
+    keys = output[['visit', 'subject']].drop_duplicates()
+    visits = pd.Categorical(keys.visit, categories=output.visit.unique())
+    keys = keys.iloc[np.argsort(visits.codes, kind='stable')]
+    df = output[output.parameter.isin(DIURNAL)]
+    wide = df.groupby(['visit', 'subject', 'parameter'], sort=False)
+    wide = wide.value.first().unstack('parameter')
+    wide = wide.reindex(index=pd.MultiIndex.from_frame(keys), 
+                        columns=DIURNAL)
+    wide.columns.name = None
+    return wide.reset_index()
+
+
+def diurnal_summary(src, session=None):
+    session = results_session.get(src, session)
+    output = session.results().drop(columns='sdev')
+    session.save('diurnal_summary', _diurnal_summary(output), index=False)
+
+
+def descriptive_statistics(src, session=None):
+    session = results_session.get(src, session)
+    output = session.table('parameters_rep')
     visits = output.visit.unique()
     v0 = output[output.visit==visits[0]]
     v0 = pd.pivot_table(v0, values='value', index='subject', 
@@ -134,8 +153,7 @@ def descriptive_statistics(src):
     v1 = pd.pivot_table(v1, values='value', index='subject', 
                         columns='parameter')
     
-    effect_file = os.path.join(path, 'effect_size.csv')
-    ef = pd.read_csv(effect_file)
+    ef = session.table('effect_size')
     ef = pd.pivot_table(ef, values='value', index='subject', 
                         columns='parameter')
     # Calculate stats
@@ -163,26 +181,28 @@ def descriptive_statistics(src):
         "kbh "+visits[0]+" (mL/min/100cm3)",
         "kbh "+visits[1]+" (mL/min/100cm3)",
         ])
-    stats.to_csv(os.path.join(path, 'k_descriptive_stats.csv'))
+    session.save('k_descriptive_stats', stats)
+
 
 
+def averages(src, session=None, bootstrap=None):
 
-def averages(src):
+    # bootstrap are the settings of the bootstrap confidence intervals
+    # on the effect sizes (see bootstrap.options).
     
-    path = os.path.join(src, 'Analysis')
-    if not os.path.exists(path):
-        os.makedirs(path)
-
-    df = pd.read_csv(os.path.join(path, 'parameters_rep.csv'))
-    df['group'] = lookup(src, df.parameter.values, 'group')
-    df['unit'] = lookup(src, df.parameter.values, 'unit') 
-    df['description'] = lookup(src, df.parameter.values, 'description')
+    session = results_session.get(src, session)
+    bootstrap = boot.options(**(bootstrap or {}))
+
+    df = session.table('parameters_rep')
+    df['group'] = session.lookup(df.parameter.values, 'group')
+    df['unit'] = session.lookup(df.parameter.values, 'unit') 
+    df['description'] = session.lookup(df.parameter.values, 'description')
     visits = df.visit.unique()
-    eff = pd.read_csv(os.path.join(path, 'effect_size.csv'))
+    eff = session.table('effect_size')
     eff['visit'] = 'change (%)'
-    eff['group'] = lookup(src, eff.parameter.values, 'group')
-    eff['unit'] = lookup(src, eff.parameter.values, 'unit') 
-    eff['description'] = lookup(src, eff.parameter.values, 'description')
+    eff['group'] = session.lookup(eff.parameter.values, 'group')
+    eff['unit'] = session.lookup(eff.parameter.values, 'unit') 
+    eff['description'] = session.lookup(eff.parameter.values, 'description')
     
     df = df[['subject','visit','group','parameter','value','unit','description']]
     eff = eff[['subject','visit','group','parameter','value','unit','description']]
@@ -219,21 +239,17 @@ def averages(src):
         '95%CI drug': r_err,
         '95%CI effect': c_err,
     }
-    file = os.path.join(path, 'avr_95CI.csv')
-    pd.DataFrame(data, index=avr.index).to_csv(file)
-
-
-def pairwise_ttest(src):
-    
-    path = os.path.join(src, 'Analysis')
-    if not os.path.exists(path):
-        os.makedirs(path)
+    if bootstrap['draws'] > 0:
+        ci = boot.effect_ci(session.table('effect_size'), **bootstrap)
+        ci = ci.reindex(avr.index.get_level_values('parameter'))
+        data['bootstrap 95%CI effect low'] = around_sig(ci.low.values, 3)
+        data['bootstrap 95%CI effect high'] = around_sig(ci.high.values, 3)
+    data = pd.DataFrame(data, index=avr.index).reset_index()
+    session.save('avr_95CI', data, index=False)
 
-    df = pd.read_csv(os.path.join(path, 'parameters_rep.csv'))
-    df['group'] = lookup(src, df.parameter.values, 'group')
-    df = df[['subject','visit','group','parameter','value']]
 
-    # Perform t-tests and save if df output
+def _pairwise_ttest_pingouin(df):
+    # One paired t-test per parameter with pingouin
     output = None
     for struct in df.group.unique():
         dfs = df[df.group==struct]
@@ -248,31 +264,54 @@ def pairwise_ttest(src):
                 output = stats
             else:
                 output = pd.concat([output, stats])
-    output['description'] = lookup(src, output.parameter.values, 'description')
-    output.to_csv(os.path.join(path, '_output_ttest.csv'))
-
-
+    return output
+
+
+def _pairwise_ttest(df):
+    # Paired t-tests of all parameters at once, from a subject x 
+    # parameter matrix for each visit. Same output as with pingouin.
+    visits = sorted(df.visit.unique())
+    if len(visits) != 2:
+        return _pairwise_ttest_pingouin(df)
+    keys = df[['group','parameter']].drop_duplicates()
+    groups = pd.Categorical(keys.group, categories=df.group.unique())
+    keys = keys.iloc[np.argsort(groups.codes, kind='stable')]
+    wide = df.pivot_table(index='subject', columns=['visit','parameter'], 
+                          values='value')
+    x = wide[visits[0]].reindex(columns=keys.parameter.values).values
+    y = wide[visits[1]].reindex(columns=keys.parameter.values).values
+    output = ttests.pairwise_tests(x, y, 'visit', visits[0], visits[1])
+    output['group'] = keys.group.values
+    output['parameter'] = keys.parameter.values
+    # Index as in the concatenated tables of pingouin
+    output.index = np.zeros(len(output), dtype=int)
+    return output
+
+
+def pairwise_ttest(src, session=None, engine=None):
+    
+    session = results_session.get(src, session)
 
+    df = session.table('parameters_rep')
+    df['group'] = session.lookup(df.parameter.values, 'group')
+    df = df[['subject','visit','group','parameter','value']]
 
-def compare_to_ref(src):
+    # Perform t-tests and save output (see ttests.engine)
+    engine = ttests.engine(engine)
+    if engine == 'pingouin':
+        output = _pairwise_ttest_pingouin(df)
+    else:
+        output = _pairwise_ttest(df)
+        if engine == 'verify':
+            ttests.verify(output, _pairwise_ttest_pingouin(df))
+    output['description'] = session.lookup(output.parameter.values, 'description')
+    session.save('_output_ttest', output)
 
-    output_file = os.path.join(src, 'all_results')
-    dmr = pydmr.read(output_file, format='table')
-    df = pd.DataFrame(dmr['pars'], columns=['subject', 'visit', 'parameter', 'value'])
-    dfsd = pd.DataFrame(dmr['sdev'], columns=['subject', 'visit', 'parameter', 'value'])
-    df['stdev'] = dfsd['value'].values
 
-    df_ref = pd.read_csv(
-        os.path.join(os.getcwd(), 'src', 'methods', 'reference.csv')
-    )
 
-    # Add column and merge
-    df['source'] = 'data'
-    df_ref['source'] = 'reference'
-    df = pd.concat((df_ref, df))
-    df['group'] = lookup(src, df.parameter.values, 'group')
 
-    # Perform t-tests and save if df output
+def _compare_to_ref_pingouin(df):
+    # One t-test per parameter and visit with pingouin
     output = None
     for struct in df.group.unique():
         dfs = df[df.group==struct]
@@ -292,25 +331,76 @@ def compare_to_ref(src):
                     output = stats
                 else:
                     output = pd.concat([output, stats])
-    output = output.sort_values(['visit','group','parameter'])
+    return output
+
+
+def _compare_to_ref(df):
+    # T-tests of all parameters and visits at once, with the values 
+    # of each source padded into a matrix with one column per test.
+    keys = ['group','parameter','visit']
+    sources = df.groupby(keys, sort=False).source.nunique()
+    tests = sources[sources==2].index
+    row = df.groupby(keys + ['source']).cumcount()
+    wide = df.assign(row=row).pivot(index='row', 
+        columns=['source'] + keys, values='value')
+    x = wide['reference'].reindex(columns=tests).values
+    y = wide['data'].reindex(columns=tests).values
+    output = ttests.ttest(x, y)
+    for i, key in enumerate(keys):
+        output[key] = tests.get_level_values(i)
+    output.index = np.zeros(len(output), dtype=int)
+    return output
+
+
+def compare_to_ref(src, session=None, engine=None):
+
+    session = results_session.get(src, session)
+    df = session.results().rename(columns={'sdev': 'stdev'})
+
+    df_ref = pd.read_csv(
+        os.path.join(os.getcwd(), 'src', 'methods', 'reference.csv')
+    )
+
+    # Add column and merge
+    df['source'] = 'data'
+    df_ref['source'] = 'reference'
+    df = pd.concat((df_ref, df))
+    df['group'] = session.lookup(df.parameter.values, 'group')
+
+    # Perform t-tests (see ttests.engine)
+    engine = ttests.engine(engine)
+    if engine == 'pingouin':
+        output = _compare_to_ref_pingouin(df)
+    else:
+        output = _compare_to_ref(df)
+        if engine == 'verify':
+            reference = _compare_to_ref_pingouin(df)
+            reference = reference.sort_values(['visit','group','parameter'])
+            ttests.verify(
+                output.sort_values(['visit','group','parameter']), reference)
+    output = output.sort_values(['visit','group','parameter'], kind='stable')
 
     # Update output array
     output.reset_index(drop=True, inplace=True)
     output.drop(columns=['T', 'dof', 'alternative'], inplace=True)
-    output['description'] = lookup(src, output.parameter.values, 'description')
-    output['unit'] = lookup(src, output.parameter.values, 'unit') 
+    output['description'] = session.lookup(output.parameter.values, 'description')
+    output['unit'] = session.lookup(output.parameter.values, 'unit') 
     output = output[['group','description', 'unit', 'visit', 
                      'p-val', 'BF10', 'power']]
     output.rename(columns={'description': "Biomarker", "unit": "Units", 
                            "p-val": "p-value", 'BF10': 'Bayes Factor', 
                            'power': 'Power'}, inplace=True)
-    output = output.sort_values(['group','p-value'], ascending=True)
+    # Round before sorting so that tied p-values (e.g. p=1) keep the
+    # visit/group/parameter order whichever engine computed them
+    output.loc[:,'p-value'] = np.around(output['p-value'].values, 5)
+    output = output.sort_values(['group','p-value'], ascending=True, 
+                                kind='stable')
     output.set_index('Biomarker', inplace=True)
     output = output.astype({'Bayes Factor': 'float32'})
-    output.loc[:,'p-value'] = np.around(output['p-value'].values, 5)
     output.loc[:,'Bayes Factor'] = np.around(output['Bayes Factor'].values, 2)
     output.loc[:,'Power'] = np.around(output['Power'].values, 2)
-    output.to_csv(os.path.join(src, 'Analysis', 'difference_with_reference.csv'))
+    session.save('difference_with_reference', output.reset_index(), 
+                 index=False)
 
 
 
@@ -354,20 +444,50 @@ def round_meas(x, xerr):
     else:
         return y, yerr
     
+def _first_digits(x):
+    # first_digit for an array. Also returns a mask of the values that
+    # have a first digit - zeros, NaN and infinite values do not.
+    x = np.abs(np.asarray(x, dtype=np.float64))
+    valid = np.isfinite(x) & (x > 0)
+    n = np.zeros(x.shape, dtype=int)
+    n[valid] = -np.floor(np.log10(x[valid])).astype(int)
+    return n, valid
+
+def _around(x, decimals):
+    # np.round(x, decimals), as used by round() on numpy floats, for 
+    # an array of decimals.
+    x = np.asarray(x, dtype=np.float64)
+    decimals = np.asarray(decimals)
+    # Powers of ten computed as in numpy - beyond 1e22 these are not 
+    # exact and depend on how they are computed.
+    n = np.abs(decimals)
+    powers = [10.0**k for k in range(10)]
+    for k in range(10, n.max(initial=0) + 1):
+        powers.append(powers[-1]*10.)
+    scale = np.array(powers)[n]
+    with np.errstate(over='ignore', invalid='ignore'):
+        pos = np.rint(x*scale)/scale
+        neg = np.rint(x/scale)*scale
+    return np.where(decimals >= 0, pos, neg)
+
 def around_sig(x, n):
-    return np.array([round_sig(v,n) for v in x])
+    # round_sig for an array
+    x = np.asarray(x, dtype=np.float64)
+    digits, valid = _first_digits(x)
+    return np.where(valid, _around(x, digits + (n-1)), x)
 
 def around_meas(x, xerr):
-    n = len(x)
-    if len(xerr) != n:
+    # round_meas for arrays
+    x = np.asarray(x, dtype=np.float64)
+    xerr = np.asarray(xerr, dtype=np.float64)
+    if xerr.shape != x.shape:
         raise ValueError(
             "The array with error values must have the same length as the "
             "array with measurements."
         )
-    y = np.empty(n)
-    yerr = np.empty(n)
-    for i in range(n):
-        y[i], yerr[i] = round_meas(x[i], xerr[i])
+    digits, valid = _first_digits(xerr)
+    y = np.where(valid, _around(x, digits), x)
+    yerr = np.where(valid, _around(xerr, digits), xerr)
     return y, yerr
 
 if __name__ == '__main__':
@@ -382,6 +502,14 @@ if __name__ == '__main__':
     assert round_meas(123.654, 67.8) == (120, 70)
     assert round_meas(123.654, 678) == (100, 700)
     assert round_meas(123.654, 6780) == (0, 7000)
+    x = np.array([123.654]*6)
+    xerr = np.array([0.0678, 0.678, 6.78, 67.8, 678, 6780])
+    y, yerr = around_meas(x, xerr)
+    assert y.tolist() == [123.65, 123.7, 124, 120, 100, 0]
+    assert yerr.tolist() == [0.07, 0.7, 7, 70, 700, 7000]
+    assert np.array_equal(
+        around_sig(np.array([0, np.nan, -0.0163, 2.675, -163]), 2), 
+        np.array([0, np.nan, -0.016, 2.7, -160]), equal_nan=True)
 
 
 
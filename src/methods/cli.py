@@ -0,0 +1,149 @@
+import os
+import argparse
+
+
+def options():
+    # Command line options shared by the entry scripts. Scripts can 
+    # add their own options to the parser before parsing.
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help=(
+            'Number of parallel processes for the per-subject fits '
+            '(default: $TRISTAN_WORKERS or 1). Use 0 for all cores.'
+        ),
+    )
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='Refit all subjects instead of restoring cached fits.',
+    )
+    parser.add_argument(
+        '--force', action='store_true',
+        help='Rerun all stages, including those that are up to date.',
+    )
+    parser.add_argument(
+        '--warm-start', action='store_true',
+        help=(
+            'Fit the acquisition times of each subject as one sweep, '
+            'starting each fit from the previous one.'
+        ),
+    )
+    parser.add_argument(
+        '--warm-verify', action='store_true',
+        help=(
+            'Check each warm-started fit against a cold-start fit, and '
+            'use the cold start if they differ by more than --warm-tol.'
+        ),
+    )
+    parser.add_argument(
+        '--warm-tol', type=float, default=None,
+        help=(
+            'Relative tolerance of warm-started fits against cold-start '
+            'fits (default: $TRISTAN_WARM_TOL or 0.01).'
+        ),
+    )
+    parser.add_argument(
+        '--plots', choices=['all', 'key', 'off'], default=None,
+        help=(
+            'Per-subject plots: all windows, the key plot only, or none '
+            '(default: $TRISTAN_PLOTS or all).'
+        ),
+    )
+    parser.add_argument(
+        '--plot-workers', type=int, default=None,
+        help=(
+            'Number of parallel processes for the per-subject plots '
+            '(default: $TRISTAN_PLOT_WORKERS or the number of workers).'
+        ),
+    )
+    parser.add_argument(
+        '--report-workers', type=int, default=None,
+        help=(
+            'Number of reports built at the same time (default: '
+            '$TRISTAN_REPORT_WORKERS or the number of workers).'
+        ),
+    )
+    parser.add_argument(
+        '--report-budget', type=float, default=None,
+        help=(
+            'Size budget (MB) of the per-subject plots of an experiment '
+            'in the reports (default: $TRISTAN_REPORT_BUDGET or 20).'
+        ),
+    )
+    parser.add_argument(
+        '--bar-charts', choices=['files', 'pages', 'both'], default=None,
+        help=(
+            'Bar charts of the values per visit: one file per parameter, '
+            'pages with several parameters each, or both (default: '
+            '$TRISTAN_BAR_CHARTS or files).'
+        ),
+    )
+    parser.add_argument(
+        '--no-dmr', action='store_true',
+        help='Do not export the results of each experiment as .dmr.',
+    )
+    parser.add_argument(
+        '--offline', action='store_true',
+        help='Only use datasets that are already in the local data store.',
+    )
+    parser.add_argument(
+        '--stats', choices=['numpy', 'pingouin', 'verify'], default=None,
+        help=(
+            'Engine for the t-tests: all parameters at once (numpy), one '
+            'test at a time (pingouin), or both with a check that they '
+            'agree (verify). Default: $TRISTAN_STATS or numpy.'
+        ),
+    )
+    parser.add_argument(
+        '--bootstrap', type=int, default=None,
+        help=(
+            'Number of draws for bootstrap confidence intervals on the '
+            'effect sizes (default: $TRISTAN_BOOTSTRAP or 0 = none).'
+        ),
+    )
+    parser.add_argument(
+        '--seed', type=int, default=None,
+        help='Seed of the bootstrap (default: $TRISTAN_BOOTSTRAP_SEED or 0).',
+    )
+    return parser
+
+
+def parse_args(argv=None, parser=None):
+    # Options are passed on through environment variables so they 
+    # also reach the methods called by each script.
+    if parser is None:
+        parser = options()
+    args = parser.parse_args(argv)
+    if args.workers is not None:
+        os.environ['TRISTAN_WORKERS'] = str(args.workers)
+    if args.no_cache:
+        os.environ['TRISTAN_NO_CACHE'] = '1'
+    if args.warm_start:
+        os.environ['TRISTAN_WARM_START'] = '1'
+    if args.warm_verify:
+        os.environ['TRISTAN_WARM_VERIFY'] = '1'
+    if args.warm_tol is not None:
+        os.environ['TRISTAN_WARM_TOL'] = str(args.warm_tol)
+    if args.plots is not None:
+        os.environ['TRISTAN_PLOTS'] = args.plots
+    if args.plot_workers is not None:
+        os.environ['TRISTAN_PLOT_WORKERS'] = str(args.plot_workers)
+    if args.report_workers is not None:
+        os.environ['TRISTAN_REPORT_WORKERS'] = str(args.report_workers)
+    if args.report_budget is not None:
+        os.environ['TRISTAN_REPORT_BUDGET'] = str(args.report_budget)
+    if args.bar_charts is not None:
+        os.environ['TRISTAN_BAR_CHARTS'] = args.bar_charts
+    if args.no_dmr:
+        os.environ['TRISTAN_NO_DMR'] = '1'
+    if args.offline:
+        os.environ['TRISTAN_OFFLINE'] = '1'
+    if args.force:
+        os.environ['TRISTAN_FORCE'] = '1'
+    if args.stats is not None:
+        os.environ['TRISTAN_STATS'] = args.stats
+    if args.bootstrap is not None:
+        os.environ['TRISTAN_BOOTSTRAP'] = str(args.bootstrap)
+    if args.seed is not None:
+        os.environ['TRISTAN_BOOTSTRAP_SEED'] = str(args.seed)
+    return args
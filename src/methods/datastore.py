@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+import miblab
+
+
+# Each dataset in the store has a record with its checksum, saved
+# next to it as <dataset>.json
+RECORD = '.json'
+
+
+def folder():
+    # Location of the data store, set with the environment variable
+    # TRISTAN_DATA (default data in the working directory).
+    return os.environ.get(
+        'TRISTAN_DATA',
+        os.path.join(os.getcwd(), 'data'),
+    )
+
+
+def is_offline(offline=None):
+    # If offline is not provided, the store is offline if the
+    # environment variable TRISTAN_OFFLINE is set. An offline store
+    # never downloads.
+    if offline is None:
+        return os.environ.get('TRISTAN_OFFLINE', '0') not in ['', '0']
+    return offline
+
+
+def checksum(file):
+    h = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _write_record(file, record, sha256=None):
+    if sha256 is None:
+        sha256 = checksum(file)
+    tmp = record + '.' + str(os.getpid()) + '.tmp'
+    stat = os.stat(file)
+    with open(tmp, 'w') as f:
+        json.dump({
+            'sha256': sha256,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+        }, f, indent=1)
+    os.replace(tmp, record)
+
+
+def verify(file, full=False):
+    # Check a dataset against its record. The checksum is only
+    # recomputed if the file has changed size or modification time
+    # since it was recorded, or if full=True. A dataset that was
+    # added to the store by hand is recorded on first use.
+    record = file + RECORD
+    if not os.path.exists(record):
+        _write_record(file, record)
+        return file
+    with open(record, 'r') as f:
+        rec = json.load(f)
+    stat = os.stat(file)
+    if not full and (stat.st_size, stat.st_mtime_ns) == (
+            rec['size'], rec['mtime_ns']):
+        return file
+    if checksum(file) != rec['sha256']:
+        raise ValueError(
+            f"The checksum of {file} does not match the data store "
+            f"record. The file may be corrupted - delete it with "
+            f"tristan_data.py purge to download it again."
+        )
+    # Same content with a new modification time (e.g. after a copy)
+    _write_record(file, record, rec['sha256'])
+    return file
+
+
+@contextmanager
+def _lock(file, timeout=3600):
+    # Only one process downloads a dataset at a time. Locks older
+    # than timeout (sec) are left by interrupted downloads and removed.
+    lock = file + '.lock'
+    while True:
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock) > timeout:
+                    os.remove(lock)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(1)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock)
+
+
+def fetch(dataset, offline=None):
+
+    # Return the path to a dataset in the store, downloading it from
+    # Zenodo if it is not in the store yet. Datasets are downloaded
+    # to a temporary file and moved into place when complete, so
+    # concurrent readers never see a partial download. Datasets in
+    # the store are read-only.
+
+    path = folder()
+    file = os.path.join(path, dataset)
+    if os.path.exists(file):
+        return verify(file)
+    if is_offline(offline):
+        raise FileNotFoundError(
+            f"{dataset} is not in the data store {path}, and "
+            f"downloads are switched off (offline mode)."
+        )
+    os.makedirs(path, exist_ok=True)
+    with _lock(file):
+        # Another process may have downloaded it in the meantime
+        if os.path.exists(file):
+            return verify(file)
+        print('Downloading ', dataset)
+        tmp = tempfile.mkdtemp(dir=path, prefix='.download-')
+        try:
+            download = miblab.zenodo_fetch(dataset, tmp)
+            os.chmod(download, 0o444)
+            _write_record(download, file + RECORD)
+            os.replace(download, file)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+    return file
+
+
+def datasets():
+    path = folder()
+    if not os.path.exists(path):
+        return []
+    return sorted(
+        f for f in os.listdir(path)
+        if os.path.exists(os.path.join(path, f + RECORD))
+    )
+
+
+def purge(dataset=None):
+    # Delete a dataset from the store, or all datasets if none is
+    # provided.
+    path = folder()
+    if dataset is None:
+        for dataset in datasets():
+            purge(dataset)
+        return
+    for file in [dataset, dataset + RECORD]:
+        file = os.path.join(path, file)
+        if os.path.exists(file):
+            # Read-only files cannot be deleted on Windows
+            os.chmod(file, 0o644)
+            os.remove(file)
@@ -1,6 +1,9 @@
 import os
 
-from methods import onescan, twoscan, plot, calc, tables
+from methods import onescan, twoscan, plot, calc, tables, stages, tools, store
+from methods import ttests
+from methods import bootstrap as boot
+from methods.session import Session
 
 ONESCAN = 'results (one scan)'
 TWOSCAN = 'results (two scans)'
@@ -8,67 +11,166 @@ VART = 'results (one scan - variable tacq)'
 
 
 def run(
-        dmr_file, 
-        resultspath, 
+        dmr_file,
+        resultspath,
         effect_range=([-100,200], [-100,500]),
         k_max = [100, 10],
         acq_times=[5,10,15,20,25,30,35,40],
         ref=True,
         compute=True,
+        workers=None,
+        warm_start=None,
+        warm_verify=None,
+        tol=None,
+        cache=None,
+        force=False,
+        plots=None,
+        plot_workers=None,
+        bootstrap=None,
     ):
 
+    # Each stage is skipped if its inputs have not changed since the
+    # last run, unless force=True. bootstrap is the number of draws 
+    # for bootstrap confidence intervals on the effect sizes (see 
+    # bootstrap.options). warm_start, warm_verify and tol select the 
+    # warm-started sweep over the acquisition times and its check 
+    # (see onescan.sweep_options).
+
     if compute:
 
         # Onescan
         path = os.path.join(resultspath, ONESCAN)
-        onescan.compute(dmr_file, path)
+        onescan.compute(dmr_file, path, workers=workers, cache=cache,
+                        force=force)
 
         # Twoscan
         path = os.path.join(resultspath, TWOSCAN)
-        twoscan.compute(dmr_file, path)
+        twoscan.compute(dmr_file, path, workers=workers, cache=cache,
+                        force=force)
 
         # Variable time
         path = os.path.join(resultspath, VART)
-        onescan.compute_vart(dmr_file, path, acq_times=acq_times)
+        onescan.compute_vart(
+            dmr_file, path, acq_times=acq_times, workers=workers,
+            warm_start=warm_start, verify=warm_verify, tol=tol, 
+            cache=cache, force=force,
+        )
+
+        # Per-subject plots of the fits, made after all fits are 
+        # done (plots is 'all', 'key' or 'off').
+        onescan.plots(dmr_file, os.path.join(resultspath, ONESCAN), 
+                      workers=plot_workers, mode=plots, force=force)
+        twoscan.plots(dmr_file, os.path.join(resultspath, TWOSCAN), 
+                      workers=plot_workers, mode=plots, force=force)
+        onescan.plots(dmr_file, os.path.join(resultspath, VART), 
+                      acq_times=acq_times, workers=plot_workers, 
+                      mode=plots, force=force)
+
+    reference = os.path.join(os.getcwd(), 'src', 'methods', 'reference.csv')
+    bootstrap = boot.options(draws=bootstrap)
+
+    # Results of each experiment are loaded once and shared by all 
+    # stages, together with the tables that the stages derive.
+    session = {
+        exp: Session(os.path.join(resultspath, exp)) 
+        for exp in [ONESCAN, TWOSCAN, VART]
+    }
 
     # Compute statistics
     for exp in [ONESCAN, TWOSCAN]:
         path = os.path.join(resultspath, exp)
-        calc.effect_size(path)
-        calc.descriptive_statistics(path)
-        calc.averages(path)
-        calc.pairwise_ttest(path)
+        results, pars, effect = _files(path)
+        stages.run(path, 'effect_size', calc.effect_size, path,
+                   session=session[exp], inputs=[results], force=force)
+        stages.run(path, 'descriptive_statistics',
+                   calc.descriptive_statistics, path,
+                   session=session[exp], inputs=[pars, effect], force=force)
+        stages.run(path, 'averages', calc.averages, path,
+                   session=session[exp], bootstrap=bootstrap, 
+                   inputs=[results, pars, effect], force=force)
+        stages.run(path, 'pairwise_ttest', calc.pairwise_ttest, path,
+                   session=session[exp], engine=ttests.engine(), 
+                   inputs=[results, pars], force=force)
 
     # Create plots
     for exp in [ONESCAN, TWOSCAN]:
         path = os.path.join(resultspath, exp)
-        plot.create_bar_chart(path)
-        plot.effect_plot(path, ylim=k_max, ref=ref)
+        results, pars, effect = _files(path)
+        stages.run(path, 'bar_chart', plot.create_bar_chart, path,
+                   session=session[exp], mode=plot.bar_chart_mode(), 
+                   inputs=[results], force=force)
+        stages.run(path, 'effect_plot', plot.effect_plot, path,
+                   ylim=k_max, ref=ref, session=session[exp],
+                   inputs=[pars, effect, reference], force=force)
     path = os.path.join(resultspath, TWOSCAN)
-    plot.diurnal_k(path, ylim=k_max)
-    
+    results, pars, effect = _files(path)
+    stages.run(path, 'diurnal_summary', calc.diurnal_summary, path,
+               session=session[TWOSCAN], inputs=[results], force=force)
+    summary = os.path.join(path, 'Analysis', 'diurnal_summary.csv')
+    stages.run(path, 'diurnal_k', plot.diurnal_k, path, ylim=k_max,
+               session=session[TWOSCAN], inputs=[summary], force=force)
+
     # Create tables
     for exp in [ONESCAN, TWOSCAN]:
         path = os.path.join(resultspath, exp)
-        tables.averages(path)
-        tables.pairwise_stats(path)
-        tables.cases(path)
-    
+        results, pars, effect = _files(path)
+        analysis = os.path.join(path, 'Analysis')
+        stages.run(path, 'tables.averages', tables.averages, path,
+                   session=session[exp],
+                   inputs=[os.path.join(analysis, 'avr_95CI.csv')],
+                   force=force)
+        stages.run(path, 'tables.pairwise_stats', tables.pairwise_stats,
+                   path, session=session[exp],
+                   inputs=[os.path.join(analysis, '_output_ttest.csv')],
+                   force=force)
+        stages.run(path, 'tables.cases', tables.cases, path,
+                   session=session[exp], inputs=[results, pars, effect],
+                   force=force)
+
     # Variable acquisition time results
     path = os.path.join(resultspath, VART)
-    calc.derive_vart_pars(path)
-    plot.vart_effect_plot(
-        path, os.path.join(resultspath, TWOSCAN), 
-        ylim=effect_range,
+    results, pars, effect = _files(path)
+    stages.run(path, 'vart_pars', calc.derive_vart_pars, path,
+               session=session[VART], inputs=[results], force=force)
+    path_2scan = os.path.join(resultspath, TWOSCAN)
+    stages.run(
+        path, 'vart_effect_plot', plot.vart_effect_plot, path, path_2scan,
+        ylim=effect_range, session=session[VART], 
+        session_2scan=session[TWOSCAN], 
+        inputs=[effect, _files(path_2scan)[2]],
+        force=force,
     )
 
     path = os.path.join(resultspath, TWOSCAN)
+    results, pars, effect = _files(path)
+    analysis = os.path.join(path, 'Analysis')
     if ref:
         # Compare to reference results
-        calc.effect_size(path, ref=True)
-        calc.compare_to_ref(path)
-        plot.compare_to_ref(path)
-        tables.reference(path)
+        stages.run(path, 'reference', calc.effect_size, path, ref=True,
+                   session=session[TWOSCAN], inputs=[results], force=force)
+        stages.run(path, 'compare_to_ref', calc.compare_to_ref, path,
+                   session=session[TWOSCAN], engine=ttests.engine(), 
+                   inputs=[results, reference], force=force)
+        stages.run(path, 'plot.compare_to_ref', plot.compare_to_ref, path,
+                   session=session[TWOSCAN], inputs=[results, reference],
+                   force=force)
+        stages.run(path, 'tables.reference', tables.reference, path,
+            session=session[TWOSCAN], 
+            inputs=[os.path.join(analysis, 'difference_with_reference.csv')],
+            force=force)
     else:
         # Generate reference data for future studies
-        calc.effect_size(path, ref=True)        
\ No newline at end of file
+        stages.run(path, 'reference', calc.effect_size, path, ref=True,
+                   session=session[TWOSCAN], inputs=[results], force=force)
+
+    print('Peak memory (MB): ', tools.peak_memory())
+
+
+def _files(path):
+    # Results files that are inputs to the analysis stages
+    analysis = os.path.join(path, 'Analysis')
+    return (
+        store.files(path),
+        os.path.join(analysis, 'parameters_rep.csv'),
+        os.path.join(analysis, 'effect_size.csv'),
+    )
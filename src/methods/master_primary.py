@@ -1,23 +1,31 @@
-from methods import twoscan, plot, calc, tables
+from methods import twoscan, plot, calc, tables, tools
+from methods.session import Session
 
-def run(dmr_file, path, k_max=[100, 10]):
+def run(dmr_file, path, k_max=[100, 10], workers=None, cache=None, 
+        plots=None, plot_workers=None):
 
     # Compute all results
-    twoscan.compute(dmr_file, path)
+    twoscan.compute(dmr_file, path, workers=workers, cache=cache)
+    twoscan.plots(dmr_file, path, workers=plot_workers, mode=plots)
+
+    # Results are loaded once and shared by all stages
+    session = Session(path)
 
     # Compute statistics
-    calc.effect_size(path)
-    calc.descriptive_statistics(path)
-    calc.averages(path)
-    calc.pairwise_ttest(path)
+    calc.effect_size(path, session=session)
+    calc.descriptive_statistics(path, session=session)
+    calc.averages(path, session=session)
+    calc.pairwise_ttest(path, session=session)
+    calc.diurnal_summary(path, session=session)
 
     # Create plots
-    plot.create_bar_chart(path)
-    plot.effect_plot(path, ylim=k_max)
-    plot.diurnal_k(path, ylim=k_max)
+    plot.create_bar_chart(path, session=session)
+    plot.effect_plot(path, ylim=k_max, session=session)
+    plot.diurnal_k(path, ylim=k_max, session=session)
     
     # Create tables
-    tables.averages(path)
-    tables.pairwise_stats(path)
-    tables.cases(path)
-      
\ No newline at end of file
+    tables.averages(path, session=session)
+    tables.pairwise_stats(path, session=session)
+    tables.cases(path, session=session)
+
+    print('Peak memory (MB): ', tools.peak_memory())
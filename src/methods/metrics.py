@@ -0,0 +1,196 @@
+import dcmri as dc
+import numpy as np
+
+
+# Registry of biomarkers derived from a trained model: areas under the
+# concentration curves over a number of windows, relative enhancements
+# at a fixed time and the measured T1-MOLLI values. Each biomarker is
+# a function of the simulated curves and the measured data (see
+# Curves). All biomarkers of a fit are evaluated together, so that
+# each simulation is only run once. Biomarkers can be added with
+# register and computed from saved fits without training the models
+# again (see onescan.biomarkers and twoscan.biomarkers).
+#
+# The curves of a window are not the first part of those of a longer
+# window, as dcmri stops adding recirculation passes when the dose
+# left inside the simulated time is small. Each window is therefore
+# simulated separately. The concentrations and relaxation rates of a
+# window come from a single simulation.
+
+# Windows of the AUCs as parameter prefix: [duration (min after the
+# bolus arrival), description]
+AUC_WINDOWS = {
+    'AUC': [180, '0-inf'],
+    'AUC35': [35, '0-35min'],
+}
+
+# Time of the relative enhancements (min after the bolus arrival)
+RE_TIME = 20
+
+# Registered biomarkers by name, in the order in which they are
+# exported
+BIOMARKERS = {}
+
+
+def simulate(model, duration):
+
+    # Concentrations and relaxation rates of a trained AortaLiver or
+    # AortaLiver2scan model up to duration (sec) after the bolus
+    # arrival. The result is the same as model.conc() and
+    # model.relax(), which each simulate the model again.
+
+    model.tmax = model.BAT + duration
+    t, cb, C = model.conc(sum=False)
+    rb = dc.relaxivity(model.field_strength, 'blood', model.agent)
+    rp = dc.relaxivity(model.field_strength, 'plasma', model.agent)
+    R1b = model.R10a + rb*cb
+    if 'IC' in model.kinetics:
+        rh = dc.relaxivity(model.field_strength, 'hepatocytes', model.agent)
+        Cl = C[0, :] + C[1, :]
+        R1l = model.R10l + rp*C[0, :] + rh*C[1, :]
+    else:
+        Cl = C
+        R1l = model.R10l + rp*C
+    return {'t': t, 'cb': cb, 'Cl': Cl, 'R1b': R1b, 'R1l': R1l}
+
+
+class Curves:
+
+    # Simulated curves of a trained model and the measured data, shared
+    # by the biomarkers that are evaluated together. tb, Sb and tl, Sl
+    # are the measured aorta and liver signals, and params the measured
+    # parameters of the subject and visit. Calling with a duration (min
+    # after the bolus arrival) returns the simulated curves (see
+    # simulate), which are computed on first use only.
+
+    def __init__(self, model, tb, Sb, tl, Sl, params):
+        self.model = model
+        self.signals = {'Sb': (tb, Sb), 'Sl': (tl, Sl)}
+        self.params = params
+        self._curves = {}
+
+    def __call__(self, duration):
+        if duration not in self._curves:
+            self._curves[duration] = simulate(self.model, 60*duration)
+        return self._curves[duration]
+
+
+def register(name, description, unit, func, label=None, aorta=False):
+    # Add a biomarker to the registry, or replace one. func computes
+    # the value from the Curves of a fit. label is the short name in
+    # tables and plots, and aorta is True for biomarkers of the aorta.
+    BIOMARKERS[name] = {
+        'description': description,
+        'unit': unit,
+        'func': func,
+        'label': name if label is None else label,
+        'aorta': aorta,
+    }
+
+
+def auc(curve, duration):
+    # Area under the curve 'cb' or 'Cl' (mM*sec) over duration (min)
+    def func(c):
+        sim = c(duration)
+        return 1000*np.trapezoid(sim[curve], sim['t'])
+    return func
+
+
+def _enhancement(t, y, y0, time):
+    # Relative enhancement at the last time point before time
+    return (y[t < time][-1] - y0)/y0
+
+
+def enhancement(curve, time, duration):
+    # Relative enhancement (%) of the simulated curve 'R1b' or 'R1l'
+    # at time (min), from a simulation over duration (min)
+    def func(c):
+        sim = c(duration)
+        tRE = c.model.BAT + 60*time
+        return 100*_enhancement(sim['t'], sim[curve], sim[curve][0], tRE)
+    return func
+
+
+def signal_enhancement(signal, time):
+    # Relative enhancement (%) of the measured signal 'Sb' or 'Sl' at
+    # time (min), relative to the baseline up to 30 sec before the
+    # bolus arrival
+    def func(c):
+        t, S = c.signals[signal]
+        S0 = np.mean(S[t < c.model.BAT - 30])
+        return 100*_enhancement(t, S, S0, c.model.BAT + 60*time)
+    return func
+
+
+def measured(param, scale=None):
+    # A measured parameter, optionally divided by scale
+    def func(c):
+        if scale is None:
+            return c.params[param]
+        return c.params[param]/scale
+    return func
+
+
+def evaluate(model, tb, Sb, tl, Sl, params, names=None):
+
+    # Biomarkers of a trained model in the format of
+    # model.export_params. names selects registered biomarkers (default
+    # all of them).
+
+    if names is None:
+        names = list(BIOMARKERS)
+    c = Curves(model, tb, Sb, tl, Sl, params)
+    values = {}
+    for name in names:
+        b = BIOMARKERS[name]
+        values[name] = [b['description'], b['func'](c), b['unit'], 0]
+    return values
+
+
+def label(par):
+    # Short label of a registered biomarker
+    if par in BIOMARKERS:
+        return BIOMARKERS[par]['label']
+    return par
+
+
+def aorta(par):
+    # True for registered biomarkers of the aorta
+    return par in BIOMARKERS and BIOMARKERS[par]['aorta']
+
+
+def _register_defaults():
+
+    for prefix, (duration, desc) in AUC_WINDOWS.items():
+        window = '' if prefix == 'AUC' else str(duration) + ','
+        register(prefix + '_Cb', f'AUC for Cb ({desc})', 'mM*sec',
+                 auc('cb', duration), label=f'AUC({window}b)', aorta=True)
+        register(prefix + '_Cl', f'AUC for Cl ({desc})', 'mM*sec',
+                 auc('Cl', duration), label=f'AUC({window}l)')
+
+    # Relative enhancements, from the simulation of the longest window
+    duration = max(w[0] for w in AUC_WINDOWS.values())
+    for curve in ['R1b', 'R1l']:
+        register('RE_' + curve, f'RE for {curve} at {RE_TIME}min', '%',
+                 enhancement(curve, RE_TIME, duration),
+                 label=f'RE{curve[:2]}({curve[2]})',
+                 aorta=curve == 'R1b')
+    for signal in ['Sb', 'Sl']:
+        register('RE_' + signal, f'RE for {signal} at {RE_TIME}min', '%',
+                 signal_enhancement(signal, RE_TIME),
+                 label=f'RES({signal[1]})', aorta=signal == 'Sb')
+
+    # MOLLI values
+    register('T1_1', 'Liver T1-MOLLI at baseline', 'sec',
+             measured('T1_liver_1'), label='T1(1)')
+    register('T1_2', 'Liver T1-MOLLI at 45min', 'sec',
+             measured('T1_liver_2'), label='T1(45)')
+
+    # Timings needed for plotting etc
+    register('t1_MOLLI', 'Time of T1-MOLLI at baseline', 'hrs',
+             measured('T1_time_1', 60*60))
+    register('t2_MOLLI', 'Time of T1-MOLLI at 45min', 'hrs',
+             measured('T1_time_2', 60*60))
+
+
+_register_defaults()
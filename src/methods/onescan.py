@@ -1,65 +1,316 @@
 import os
 import time
 
+import numpy as np
 import dcmri as dc
-import pydmr
 
-from methods import tools
+from methods import tools, stages, plot, store, stream, metrics
+from methods import cache as fit_cache
 
 
-def compute(datafile, resultspath):
+# Parameters used to check warm-started fits of the acquisition 
+# time sweep against cold-start fits, and the smallest value used to
+# compute their relative difference
+VART_PARS = ['khe', 'kbh']
+VART_ATOL = 1e-6
 
-    start = time.time()
 
-    if not os.path.exists(resultspath):
-        os.makedirs(resultspath)
+def sweep_options(warm_start=None, verify=None, tol=None):
+    # Settings not provided are read from the environment variables
+    # TRISTAN_WARM_START (default 0 = fit each acquisition time from
+    # a cold start), TRISTAN_WARM_VERIFY (default 0 = no check of the 
+    # warm-started fits against cold starts) and TRISTAN_WARM_TOL 
+    # (relative tolerance of the check, default 0.01).
+    if warm_start is None:
+        warm_start = os.environ.get('TRISTAN_WARM_START', '0')
+        warm_start = warm_start not in ['', '0']
+    if verify is None:
+        verify = os.environ.get('TRISTAN_WARM_VERIFY', '0')
+        verify = verify not in ['', '0']
+    if tol is None:
+        tol = float(os.environ.get('TRISTAN_WARM_TOL', '0.01') or 0.01)
+    if tol <= 0:
+        raise ValueError(
+            "The tolerance of warm-started fits must be positive."
+        )
+    return {'warm_start': warm_start, 'verify': verify, 'tol': tol}
 
-    results = []
-    data = pydmr.read(datafile, format='nest')
-    for subj in data['rois'].keys():
-        for visit in data['rois'][subj].keys():
 
-            # Train model
-            model = subject_model(data, subj, visit, verbose=2)
+def compute(datafile, resultspath, workers=None, cache=None, force=False):
 
-            # Save results
-            save_plots(model, data, subj, visit, resultspath)
-            file = save_results(model, data, subj, visit, resultspath)
+    start = time.time()
 
-            results.append(file)
+    if not os.path.exists(resultspath):
+        os.makedirs(resultspath)
 
-    file = os.path.join(resultspath, 'all_results')
-    pydmr.concat(results, file)
+    data = stream.dataset(datafile)
+    verbose = 2 if tools.workers(workers) == 1 else 0
+    tasks, names, inputs = [], [], []
+    for subj, visit in data.keys():
+        tasks.append((data, subj, visit, resultspath, verbose, 
+                      None, cache))
+        names.append('fit ' + subj + ' ' + visit)
+        inputs.append([data.fingerprint(subj, visit), 
+                       stages.source(tools, metrics)])
+
+    # Train models and save results, skipping those that are up to date
+    results = stages.pmap(resultspath, _compute_subject, tasks, names, 
+                          inputs, workers, force)
+    results = [file for files in results for file in files 
+               if file.endswith('.parquet')]
+    store.collect(resultspath, results, force=force)
 
     print('Calculation time (mins): ', (time.time()-start)/60)
 
 
 def compute_vart(datafile, resultspath, 
-                 acq_times = [5,10,15,20,25,30,35,40]):
+                 acq_times = [5,10,15,20,25,30,35,40], workers=None,
+                 warm_start=None, verify=None, tol=None, cache=None, 
+                 force=False):
+
+    # If warm_start is True, the acquisition times of each subject 
+    # and visit are fitted as one sweep from the longest to the 
+    # shortest, and each fit is initialised with the free parameters 
+    # of the previous one. If verify is True, each warm fit is also 
+    # checked against a cold-start fit with the relative tolerance 
+    # tol (see _compute_sweep). Settings not provided are read from 
+    # the environment (see sweep_options).
 
     start = time.time()
+    options = sweep_options(warm_start, verify, tol)
+    warm_start = options['warm_start']
+    verify, tol = options['verify'], options['tol']
 
     if not os.path.exists(resultspath):
         os.makedirs(resultspath)
 
-    results = []
-    data = pydmr.read(datafile, format='nest')
-    for subj in data['rois'].keys():
-        for visit in data['rois'][subj].keys():
+    data = stream.dataset(datafile)
+    verbose = 2 if tools.workers(workers) == 1 else 0
+    tasks, names, inputs = [], [], []
+    for subj, visit in data.keys():
+        if warm_start:
+            tasks.append((data, subj, visit, resultspath, 
+                          acq_times, verbose, verify, tol, cache))
+            names.append('sweep ' + subj + ' ' + visit)
+            inputs.append([data.fingerprint(subj, visit), acq_times, 
+                           verify, tol, stages.source(tools, metrics)])
+        else:
             for tacq in acq_times:
-                
-                # Train model
-                model = subject_model(data, subj, visit, verbose=2, tacq=tacq)
+                tasks.append((data, subj, visit, resultspath, 
+                              verbose, tacq, cache))
+                names.append('fit ' + subj + ' ' + visit + ' ' + str(tacq))
+                inputs.append([data.fingerprint(subj, visit), tacq, 
+                               stages.source(tools, metrics)])
+
+    # Train models and save results, skipping those that are up to date
+    func = _compute_sweep if warm_start else _compute_subject
+    results = stages.pmap(resultspath, func, tasks, names, inputs, 
+                          workers, force)
+    results = [file for files in results for file in files 
+               if file.endswith('.parquet')]
+    store.collect(resultspath, results, force=force)
+    
+    print('Calculation time (mins): ', (time.time()-start)/60)
 
-                # Save results
-                save_plots(model, data, subj, visit, resultspath, tacq=tacq)
-                file = save_results(model, data, subj, visit, resultspath, tacq=tacq)
 
-                results.append(file)
-    file = os.path.join(resultspath, 'all_results')
-    pydmr.concat(results, file)
+def plots(datafile, resultspath, acq_times=None, workers=None, mode=None,
+          windows=None, budget=None, force=False):
+
+    # Plot the fits saved by compute, or by compute_vart if acq_times 
+    # are provided. Plots run in their own process pool (see 
+    # tools.plot_workers) and the mode 'all', 'key' or 'off' selects 
+    # which plots are made (see tools.plot_mode). The report variants 
+    # of the key plots share the size budget in MB (see 
+    # plot.report_budget).
+
+    mode = tools.plot_mode(mode)
+    if mode == 'off':
+        return
     
-    print('Calculation time (mins): ', (time.time()-start)/60)
+    start = time.time()
+
+    data = stream.dataset(datafile)
+    if acq_times is None:
+        acq_times = [None]
+    keys = data.keys()
+    n = max(len(keys)*len(acq_times), 1)
+    budget = 1e6*plot.report_budget(budget)/n
+    tasks, names, inputs = [], [], []
+    for subj, visit in keys:
+        for tacq in acq_times:
+            tasks.append((data, subj, visit, resultspath, tacq, 
+                          mode, windows, budget))
+            name = 'plot ' + subj + ' ' + visit
+            if tacq is not None:
+                name += ' ' + str(tacq)
+            names.append(name)
+            inputs.append([fit_file(resultspath, subj, visit, tacq), 
+                           data.fingerprint(subj, visit), mode, windows, 
+                           budget, stages.source(plot)])
+
+    # Create plots, skipping those that are up to date
+    stages.pmap(resultspath, _plot_subject, tasks, names, inputs, 
+                tools.plot_workers(workers), force)
+
+    print('Plotting time (mins): ', (time.time()-start)/60)
+
+
+def biomarkers(datafile, resultspath, names=None, acq_times=None, 
+               workers=None):
+
+    # Compute biomarkers registered in metrics.BIOMARKERS (all or
+    # those listed in names) from the fits saved by compute, or by 
+    # compute_vart if acq_times are provided, without training the 
+    # models again. The values are added to the results or replace 
+    # those already there. Biomarkers registered while running (see
+    # metrics.register) are only known to worker processes that are 
+    # forked from this one.
+
+    start = time.time()
+
+    data = stream.dataset(datafile)
+    if acq_times is None:
+        acq_times = [None]
+    tasks = [
+        (data, subj, visit, resultspath, names, tacq) 
+        for subj, visit in data.keys() for tacq in acq_times
+    ]
+    results = tools.pmap(_biomarkers_subject, tasks, workers)
+    store.collect(resultspath, results)
+
+    print('Biomarker time (mins): ', (time.time()-start)/60)
+
+
+def _biomarkers_subject(dataset, subj, visit, resultspath, names=None, 
+                        tacq=None):
+
+    # Restore the trained model saved by compute
+    data = dataset.subset(subj, visit)
+    rois = data['rois'][subj][visit]
+    pars = data['pars'][subj][visit]
+    model = _model(rois, pars)
+    fit_cache.restore(model, fit_file(resultspath, subj, visit, tacq))
+
+    # Evaluate as in save_results
+    xdata, ydata = _data(rois)
+    tb, Sb, tl, Sl = xdata[0], ydata[0], xdata[1], ydata[1]
+    params = metrics.evaluate(model, tb, Sb, tl, Sl, pars, names=names)
+    params = tools.to_tristan_units(params)
+
+    resultspath = os.path.join(resultspath, 'Results')
+    study = visit if tacq is None else visit + '_' + str(tacq).zfill(2)
+    return store.update(resultspath, subj, study, params)
+
+
+def _plot_subject(dataset, subj, visit, resultspath, tacq=None, 
+                  mode='all', windows=None, budget=None):
+
+    # Restore the trained model saved by compute
+    data = dataset.subset(subj, visit)
+    rois = data['rois'][subj][visit]
+    pars = data['pars'][subj][visit]
+    model = _model(rois, pars)
+    fit_cache.restore(model, fit_file(resultspath, subj, visit, tacq))
+
+    return save_plots(model, data, subj, visit, resultspath, tacq=tacq, 
+                      mode=mode, windows=windows, budget=budget)
+
+
+def fit_file(path, subj, visit, tacq=None):
+    study = visit if tacq is None else visit + '_' + str(tacq).zfill(2)
+    return os.path.join(path, 'Fits', subj + '_' + study + '.pkl')
+
+
+def _compute_subject(dataset, subj, visit, resultspath, verbose=0, 
+                     tacq=None, cache=None):
+
+    # Read the data of this subject and visit only (see stream.Dataset)
+    data = dataset.subset(subj, visit)
+
+    # Train model
+    model = subject_model(data, subj, visit, verbose=verbose, tacq=tacq, 
+                          cache=cache)
+
+    # Save the trained model for the plots, and the results
+    fit = fit_cache.dump(model, fit_file(resultspath, subj, visit, tacq))
+    return [save_results(model, data, subj, visit, resultspath, tacq=tacq), 
+            fit]
+
+
+def _compute_sweep(dataset, subj, visit, resultspath, acq_times, 
+                   verbose=0, verify=False, tol=0.01, cache=None):
+
+    data = dataset.subset(subj, visit)
+    rois = data['rois'][subj][visit]
+    pars = data['pars'][subj][visit]
+    xdata, ydata = _data(rois)
+
+    files = {}
+    nfev = {}
+    nfev_check = {}
+    init = None
+    for tacq in sorted(acq_times, reverse=True):
+
+        # Train model starting from the fit to the longer acquisition
+        model = _model(rois, pars)
+        x, y = _truncate(xdata, ydata, tacq)
+        if init is not None:
+            for p, v in init.items():
+                setattr(model, p, v)
+        nfev[tacq] = _train(model, x, y, pars, verbose, tacq, cache)
+
+        # Check against a cold start if requested, and fall back to 
+        # it if the results differ by more than the tolerance, or 
+        # cannot be compared
+        if verify and (init is not None):
+            cold = _model(rois, pars)
+            nfev_check[tacq] = _train(cold, x, y, pars, verbose, tacq, 
+                                      cache)
+            warm_vals = np.array(model.params(*VART_PARS))
+            cold_vals = np.array(cold.params(*VART_PARS))
+            err = np.max(np.abs(warm_vals - cold_vals) 
+                         / np.maximum(np.abs(cold_vals), VART_ATOL))
+            print(f'{subj} {visit} tacq={tacq}: warm start differs '
+                  f'from cold start by {100*err:.2f}%')
+            if not err <= tol:
+                print(f'{subj} {visit} tacq={tacq}: using cold start.')
+                model = cold
+        init = {p: getattr(model, p) for p in model.free if p != 'BAT'}
+
+        # Save the trained model for the plots, and the results
+        fit = fit_cache.dump(model, fit_file(resultspath, subj, visit, tacq))
+        files[tacq] = [
+            save_results(model, data, subj, visit, resultspath, tacq=tacq), 
+            fit,
+        ]
+
+    # Model evaluations of the warm-started fits, and of the cold 
+    # starts that were used to check them
+    print(subj, visit, 'model evaluations per tacq:', 
+          {t: nfev[t] for t in acq_times})
+    if verify:
+        print(subj, visit, 'model evaluations of cold-start checks:', 
+              nfev_check)
+    print(subj, visit, 'model evaluations in total:', 
+          sum(nfev.values()) + sum(nfev_check.values()))
+    return [file for tacq in acq_times for file in files[tacq]]
+
+
+def _train(model, xdata, ydata, pars, verbose=0, tacq=None, cache=None):
+    # Train the model and return the number of model evaluations 
+    # (0 if the trained model is restored from the cache).
+    predict = model.predict
+    nfev = [0]
+    def counted_predict(xdata):
+        nfev[0] += 1
+        return predict(xdata)
+    model.predict = counted_predict
+    try:
+        fit_cache.train(model, xdata, ydata, pars, cache=cache, 
+                        verbose=verbose, tacq=tacq, xtol=1e-3)
+    finally:
+        del model.predict
+    return nfev[0]
 
 
 def _data(rois):
@@ -75,13 +326,16 @@ def _data(rois):
     return xdata, ydata
 
 
-def subject_model(data, subj, visit, verbose=0, tacq=None):
+def _truncate(xdata, ydata, tacq):
+    idx0, idx1 = xdata[0]<tacq*60, xdata[1]<tacq*60
+    xdata = (xdata[0][idx0], xdata[1][idx1])
+    ydata = (ydata[0][idx0], ydata[1][idx1])
+    return xdata, ydata
 
-    rois = data['rois'][subj][visit]
-    pars = data['pars'][subj][visit]
 
-    # Fit model to data
-    model = dc.AortaLiver(
+def _model(rois, pars):
+
+    return dc.AortaLiver(
 
         # Injection parameters
         weight=pars['weight'],
@@ -104,21 +358,37 @@ def subject_model(data, subj, visit, verbose=0, tacq=None):
         vol=pars['liver_volume'],
     )
 
+
+def subject_model(data, subj, visit, verbose=0, tacq=None, cache=None):
+
+    rois = data['rois'][subj][visit]
+    pars = data['pars'][subj][visit]
+
+    # Fit model to data
+    model = _model(rois, pars)
+
     # Personalise model
 
     # Truncate data if requested
     xdata, ydata = _data(rois)
     if tacq is not None:
-        idx0, idx1 = xdata[0]<tacq*60, xdata[1]<tacq*60
-        xdata = (xdata[0][idx0], xdata[1][idx1])
-        ydata = (ydata[0][idx0], ydata[1][idx1])
+        xdata, ydata = _truncate(xdata, ydata, tacq)
 
     # TRain
-    model.train(xdata, ydata, xtol=1e-3, verbose=verbose)
+    fit_cache.train(model, xdata, ydata, pars, cache=cache, 
+                    verbose=verbose, tacq=tacq, xtol=1e-3)
     return model
 
 
-def save_plots(model, data, subj, visit, path, tacq=None):
+def save_plots(model, data, subj, visit, path, tacq=None, mode='all', 
+               windows=None, budget=None):
+
+    # If mode is 'key', only the plot of the full time course is made.
+    # Otherwise one plot is also made for each of the windows (see 
+    # plot.WINDOWS). If a budget (bytes) is given, a report variant of 
+    # the full time course is saved as well (see plot.fit).
+    if mode == 'off':
+        return []
 
     rois = data['rois'][subj][visit]
     pars = data['pars'][subj][visit]
@@ -143,8 +413,7 @@ def save_plots(model, data, subj, visit, path, tacq=None):
         1/pars['T1_liver_2'],
     ]
 
-    if not os.path.exists(path):
-        os.makedirs(path)
+    os.makedirs(path, exist_ok=True)
     
     ya = [dc.signal_ss(model.S0a, R1a[0], model.TR, model.FA),
           dc.signal_ss(model.S0a, R1a[1], model.TR, model.FA)]
@@ -152,15 +421,12 @@ def save_plots(model, data, subj, visit, path, tacq=None):
           dc.signal_ss(model.S0l, R1l[1], model.TR, model.FA)]
     test=((t,ya),(t,yl))
 
-    BAT = model.BAT
-    model.plot(xdata, ydata, 
-               fname=file + '.png', ref=test, show=False)
-    model.plot(xdata, ydata, xlim=[BAT-20, BAT+1200], 
-               fname=file + '_win1.png', ref=test, show=False)
-    model.plot(xdata, ydata, xlim=[BAT-20, BAT+600], 
-               fname=file + '_win2.png', ref=test, show=False)
-    model.plot(xdata, ydata, xlim=[BAT-20, BAT+160], 
-               fname=file + '_win3.png', ref=test, show=False) 
+    xlims = {'': None}
+    if mode == 'all':
+        for w, xlim in plot.fit_windows(model.BAT, windows).items():
+            xlims['_' + w] = xlim
+    return plot.fit(model, xdata, ydata, file, xlims, ref=test, 
+                    budget=budget)
 
 
 def save_results(model, data, subj, visit, path, tacq=None):
@@ -173,7 +439,7 @@ def save_results(model, data, subj, visit, path, tacq=None):
     params = tools.export_params(model, tb, Sb, tl, Sl, pars)
 
     params = tools.to_tristan_units(params)
-    dmrpath = os.path.join(path, 'Results')
+    resultspath = os.path.join(path, 'Results')
 
     study = visit if tacq is None else visit + '_' + str(tacq).zfill(2)
-    return tools.to_dmr(dmrpath, subj, study, params)
\ No newline at end of file
+    return store.append(resultspath, subj, study, params)
\ No newline at end of file
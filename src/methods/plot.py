@@ -1,10 +1,20 @@
 import os
+import io
+from contextlib import contextmanager
+
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import pydmr
+import matplotlib
 
 from methods import calc
+from methods import session as results_session
+
+# Figures are only saved to file, so use the non-interactive backend 
+# unless another one is requested with MPLBACKEND.
+if 'MPLBACKEND' not in os.environ:
+    matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from PIL import Image
 
 
 sym = {
@@ -37,6 +47,22 @@ mark = {
 }
 
 
+@contextmanager
+def figure(*args, **kwargs):
+    # Create a figure with plt.subplots and close it on exit, also if 
+    # an error occurs, so that open figures do not accumulate.
+    fig, ax = plt.subplots(*args, **kwargs)
+    try:
+        yield fig, ax
+    finally:
+        plt.close(fig)
+
+
+def savefig(fig, file):
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    fig.savefig(file)
+
+
 def color(index: float) -> str:
     cmap = plt.get_cmap("tab20")  
     rgba_color = cmap(index)  # Get RGBA tuple
@@ -80,9 +106,9 @@ def _line_plot_ref(ax1, ax2, visits):
                  color='lightgrey')
         
 
-def _line_plots(src, ax1, ax2, ylim=[50,5], ref=False):
+def _line_plots(session, ax1, ax2, ylim=[50,5], ref=False):
 
-    output = pd.read_csv(os.path.join(src, 'Analysis', 'parameters_rep.csv'))
+    output = session.table('parameters_rep')
     visits = output.visit[output.visit!='change (%)'].unique()
 
     fontsize=10
@@ -126,10 +152,10 @@ def _line_plots(src, ax1, ax2, ylim=[50,5], ref=False):
                  markersize=markersize, color=color(si))
 
 
-def _effect_box_plots(src, ax):
+def _effect_box_plots(session, ax):
 
     pars = ['khe', 'kbh']
-    df = pd.read_csv(os.path.join(src, 'Analysis', 'effect_size.csv'))
+    df = session.table('effect_size')
     all_data = []
     for par in ['khe', 'kbh']:
         data = df[df.parameter==par].value.values.tolist()
@@ -170,18 +196,14 @@ def _effect_box_plots(src, ax):
     ax.set_ylabel('Effect size (%)', fontsize=fontsize)
 
 
-def effect_plot(src, ylim=[50,5], ref=False):
-    fig, (ax0, ax1, ax2) = plt.subplots(
-        1, 3, width_ratios=[2, 4, 4], figsize=(8,3)
-    )
-    fig.subplots_adjust(wspace=0.5)
-    _effect_box_plots(src, ax0)
-    _line_plots(src, ax1, ax2, ylim=ylim, ref=ref)
-    path = os.path.join(src, 'Figures')
-    if not os.path.exists(path):
-        os.makedirs(path)
-    plt.savefig(fname=os.path.join(path, '_effect_plot.png'))
-    plt.close()
+def effect_plot(src, ylim=[50,5], ref=False, session=None):
+    session = results_session.get(src, session)
+    with figure(1, 3, width_ratios=[2, 4, 4], figsize=(8,3)) as (fig, ax):
+        ax0, ax1, ax2 = ax
+        fig.subplots_adjust(wspace=0.5)
+        _effect_box_plots(session, ax0)
+        _line_plots(session, ax1, ax2, ylim=ylim, ref=ref)
+        savefig(fig, os.path.join(src, 'Figures', '_effect_plot.png'))
 
 
 def _compare_to_ref_box_plot(ax, all_data, ylabel=None, title=None, ylim=None):
@@ -229,11 +251,10 @@ def _compare_to_ref_box_plot(ax, all_data, ylabel=None, title=None, ylim=None):
     
 
 
-def compare_to_ref(src):
+def compare_to_ref(src, session=None):
 
-    output_file = os.path.join(src, 'all_results')
-    dmr = pydmr.read(output_file, format='table')
-    df = pd.DataFrame(dmr['pars'], columns=['subject', 'visit', 'parameter', 'value'])
+    session = results_session.get(src, session)
+    df = session.results().drop(columns='sdev')
 
     df_ref = pd.read_csv(
         os.path.join(os.getcwd(), 'src', 'methods', 'reference.csv')
@@ -245,43 +266,42 @@ def compare_to_ref(src):
     df = pd.concat((df_ref, df))
 
     # Plot boxes
-    fig, ((ax0,ax1), (ax2,ax3)) = plt.subplots(2, 2, figsize=(5,5), 
-                                               width_ratios=[1,1])
-    #fig.subplots_adjust(wspace=0.1)
-    #fig.suptitle('Comparison against reference data')
-
-    ax = {
-        'khe': {
-            'control': ax0,
-            'drug': ax1,
-        },
-        'kbh': {
-            'control': ax2,
-            'drug': ax3,
-        },
-    }
-    ylim = {
-        'khe': [0, 60],
-        'kbh': [0, 6],
-    }
-
-    for par in ['khe', 'kbh']:
-        dfp = df[df.parameter==par]
-        for visit in ['control', 'drug']:
-            dfv = dfp[dfp.visit==visit]
-            x = dfv[dfv.source=='reference'].value.values.tolist()
-            y = dfv[dfv.source=='data'].value.values.tolist()
-            ylabel = par + ' (mL/min/100mL)' if visit=='control' else None
-            title = visit if par=='khe' else None
-            _compare_to_ref_box_plot(ax[par][visit], [x,y], ylabel, title, ylim[par])
+    with figure(2, 2, figsize=(5,5), width_ratios=[1,1]) as (fig, axes):
+        (ax0,ax1), (ax2,ax3) = axes
+        #fig.subplots_adjust(wspace=0.1)
+        #fig.suptitle('Comparison against reference data')
+
+        ax = {
+            'khe': {
+                'control': ax0,
+                'drug': ax1,
+            },
+            'kbh': {
+                'control': ax2,
+                'drug': ax3,
+            },
+        }
+        ylim = {
+            'khe': [0, 60],
+            'kbh': [0, 6],
+        }
+
+        for par in ['khe', 'kbh']:
+            dfp = df[df.parameter==par]
+            for visit in ['control', 'drug']:
+                dfv = dfp[dfp.visit==visit]
+                x = dfv[dfv.source=='reference'].value.values.tolist()
+                y = dfv[dfv.source=='data'].value.values.tolist()
+                ylabel = par + ' (mL/min/100mL)' if visit=='control' else None
+                title = visit if par=='khe' else None
+                _compare_to_ref_box_plot(ax[par][visit], [x,y], ylabel, title, ylim[par])
       
-    plt.savefig(fname=os.path.join(src, 'Figures', '_compare_to_ref.png'))
-    plt.close()
+        savefig(fig, os.path.join(src, 'Figures', '_compare_to_ref.png'))
 
 
-def _ref_effect_box_plots(src, par, ax, ylim=[-100,0]):
+def _ref_effect_box_plots(session, par, ax, ylim=[-100,0]):
 
-    df = pd.read_csv(os.path.join(src, 'Analysis', 'effect_size.csv'))
+    df = session.table('effect_size')
     all_data = []
     data = df[df.parameter==par].value.values.tolist()
     all_data.append(data)
@@ -324,9 +344,9 @@ def _ref_effect_box_plots(src, par, ax, ylim=[-100,0]):
     #ax.set_ylabel('Effect size (%)', fontsize=fontsize)
 
 
-def _vart_effect_box_plots(src, par, ax, ylim=[-100,0]):
+def _vart_effect_box_plots(session, par, ax, ylim=[-100,0]):
 
-    df = pd.read_csv(os.path.join(src, 'Analysis', 'effect_size.csv'))
+    df = session.table('effect_size')
     all_data = []
     labels = df.tacq.unique()
     for tacq in labels:
@@ -372,173 +392,454 @@ def _vart_effect_box_plots(src, par, ax, ylim=[-100,0]):
     ax.set_ylabel(par + ' effect size (%)', fontsize=fontsize)
 
 
-def vart_effect_plot(src, src_2scan, ylim=None):
+def vart_effect_plot(src, src_2scan, ylim=None, session=None, 
+                     session_2scan=None):
+    session = results_session.get(src, session)
+    session_2scan = results_session.get(src_2scan, session_2scan)
     if ylim is None:
         ylim = ([-100,-80], [-100,100])
-    fig, ((ax0,ax1), (ax2,ax3)) = plt.subplots(
-        2, 2, figsize=(8,4), width_ratios=[8,1],
-    )
-    fig.subplots_adjust(wspace=0.1)
-    fig.suptitle('Effect sizes as a function of total acquisition time')
-    _vart_effect_box_plots(src, 'khe', ax0, ylim=ylim[0])
-    _vart_effect_box_plots(src, 'kbh', ax2, ylim=ylim[1])
-    _ref_effect_box_plots(src_2scan, 'khe', ax1, ylim=ylim[0])
-    _ref_effect_box_plots(src_2scan, 'kbh', ax3, ylim=ylim[1])
-    path = os.path.join(src, 'Figures')
-    if not os.path.exists(path):
-        os.makedirs(path)
-    plt.savefig(fname=os.path.join(path, '_effect_plot.png'))
-    plt.close()
-
-
-def diurnal_k(src, ylim=[50,6]):
-
-    output_file = os.path.join(src, 'all_results')
-    dmr = pydmr.read(output_file, format='table')
-    output = pd.DataFrame(dmr['pars'], columns=['subject', 'visit', 'parameter', 'value'])
-
-    visits = output.visit.unique()
+    with figure(2, 2, figsize=(8,4), width_ratios=[8,1]) as (fig, axes):
+        (ax0,ax1), (ax2,ax3) = axes
+        fig.subplots_adjust(wspace=0.1)
+        fig.suptitle('Effect sizes as a function of total acquisition time')
+        _vart_effect_box_plots(session, 'khe', ax0, ylim=ylim[0])
+        _vart_effect_box_plots(session, 'kbh', ax2, ylim=ylim[1])
+        _ref_effect_box_plots(session_2scan, 'khe', ax1, ylim=ylim[0])
+        _ref_effect_box_plots(session_2scan, 'kbh', ax3, ylim=ylim[1])
+        savefig(fig, os.path.join(src, 'Figures', '_effect_plot.png'))
+
+
+def diurnal_k(src, ylim=[50,6], session=None):
+
+    # Start and end times and rate constants of each subject and 
+    # visit (see calc.diurnal_summary), derived from the results if 
+    # they have not been saved before
+    session = results_session.get(src, session)
+    if not os.path.exists(session.file('diurnal_summary')):
+        calc.diurnal_summary(src, session=session)
+    summary = session.table('diurnal_summary', 
+                            dtype={'visit': str, 'subject': str})
+
+    visits = summary.visit.unique()
 
     fontsize=10
     titlesize=12
     markersize=6
-    fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2,2,figsize=(8,8))
-    fig.subplots_adjust(
-                    left=0.1,
-                    right=0.9,
-                    bottom=0.1,
-                    top = 0.9, 
-                    wspace=0.3,
-                    #hspace=1,
-                    )
-    ax = {
-        visits[0]+'khe': ax1,
-        visits[1]+'khe': ax2,
-        visits[0]+'kbh': ax3,
-        visits[1]+'kbh': ax4,
-    }
-    ax1.set_title(visits[0], fontsize=titlesize)
-    ax1.set_xlabel('Time of day (hrs)', fontsize=fontsize)
-    ax1.set_ylabel('khe (mL/min/100mL)', fontsize=fontsize)
-    ax1.set_ylim(0, ylim[0])
-    ax1.tick_params(axis='x', labelsize=fontsize)
-    ax1.tick_params(axis='y', labelsize=fontsize)
-    ax2.set_title(visits[1], fontsize=titlesize)
-    ax2.set_xlabel('Time of day (hrs)', fontsize=fontsize)
-    ax2.set_ylabel('khe (mL/min/100mL)', fontsize=fontsize)
-    ax2.set_ylim(0, ylim[0])
-    ax2.tick_params(axis='x', labelsize=fontsize)
-    ax2.tick_params(axis='y', labelsize=fontsize)
-    #ax3.set_title('Baseline', fontsize=titlesize)
-    ax3.set_xlabel('Time of day (hrs)', fontsize=fontsize)
-    ax3.set_ylabel('kbh (mL/min/100mL)', fontsize=fontsize)
-    ax3.set_ylim(0, ylim[1])
-    ax3.tick_params(axis='x', labelsize=fontsize)
-    ax3.tick_params(axis='y', labelsize=fontsize)
-    #ax4.set_title('Rifampicin', fontsize=titlesize)
-    ax4.set_xlabel('Time of day (hrs)', fontsize=fontsize)
-    ax4.set_ylabel('kbh (mL/min/100mL)', fontsize=fontsize)
-    ax4.set_ylim(0, ylim[1])
-    ax4.tick_params(axis='x', labelsize=fontsize)
-    ax4.tick_params(axis='y', labelsize=fontsize)
-
-    # Create box plots
-    for visit in visits:
-        df_visit = output[output.visit==visit]
-        subjects = df_visit.subject.unique()
-        for i, s in enumerate(subjects):
-            df_subj = df_visit[df_visit.subject==s]
-            for par in ['khe', 'kbh']:
-                data_subj = []
-                for p in [par+'_i', par+'_f']:
-                    df_par = df_subj[df_subj.parameter==p]
-                    if not df_par.empty:
-                        v = df_par.value.values[0]
-                        data_subj.append(v)
-                t = []
-                for p in ['t0', 't3']:
-                    df_par = df_subj[df_subj.parameter==p]
-                    if not df_par.empty:
-                        v = df_par.value.values[0]
-                        t.append(v)
-                if len(data_subj) == 2:
-                    si = i/len(subjects)
-                    ax[visit+par].plot(
-                        t, data_subj, '-', 
-                        label=s, marker=mark[int(i+1)], 
-                        markersize=markersize, color=color(si))
-    path = os.path.join(src, 'Figures')
-    if not os.path.exists(path):
-        os.makedirs(path)
-    plot_file = os.path.join(path, '_diurnal_function.png')
-    plt.savefig(fname=plot_file)
-    plt.close()
+    with figure(2, 2, figsize=(8,8)) as (fig, axes):
+        (ax1, ax2), (ax3, ax4) = axes
+        fig.subplots_adjust(
+                        left=0.1,
+                        right=0.9,
+                        bottom=0.1,
+                        top = 0.9, 
+                        wspace=0.3,
+                        #hspace=1,
+                        )
+        ax = {
+            visits[0]+'khe': ax1,
+            visits[1]+'khe': ax2,
+            visits[0]+'kbh': ax3,
+            visits[1]+'kbh': ax4,
+        }
+        ax1.set_title(visits[0], fontsize=titlesize)
+        ax1.set_xlabel('Time of day (hrs)', fontsize=fontsize)
+        ax1.set_ylabel('khe (mL/min/100mL)', fontsize=fontsize)
+        ax1.set_ylim(0, ylim[0])
+        ax1.tick_params(axis='x', labelsize=fontsize)
+        ax1.tick_params(axis='y', labelsize=fontsize)
+        ax2.set_title(visits[1], fontsize=titlesize)
+        ax2.set_xlabel('Time of day (hrs)', fontsize=fontsize)
+        ax2.set_ylabel('khe (mL/min/100mL)', fontsize=fontsize)
+        ax2.set_ylim(0, ylim[0])
+        ax2.tick_params(axis='x', labelsize=fontsize)
+        ax2.tick_params(axis='y', labelsize=fontsize)
+        #ax3.set_title('Baseline', fontsize=titlesize)
+        ax3.set_xlabel('Time of day (hrs)', fontsize=fontsize)
+        ax3.set_ylabel('kbh (mL/min/100mL)', fontsize=fontsize)
+        ax3.set_ylim(0, ylim[1])
+        ax3.tick_params(axis='x', labelsize=fontsize)
+        ax3.tick_params(axis='y', labelsize=fontsize)
+        #ax4.set_title('Rifampicin', fontsize=titlesize)
+        ax4.set_xlabel('Time of day (hrs)', fontsize=fontsize)
+        ax4.set_ylabel('kbh (mL/min/100mL)', fontsize=fontsize)
+        ax4.set_ylim(0, ylim[1])
+        ax4.tick_params(axis='x', labelsize=fontsize)
+        ax4.tick_params(axis='y', labelsize=fontsize)
+
+        # Create box plots
+        for visit in visits:
+            df_visit = summary[summary.visit==visit]
+            for i, row in enumerate(df_visit.itertuples(index=False)):
+                t = [row.t0, row.t3]
+                for par in ['khe', 'kbh']:
+                    data_subj = [
+                        getattr(row, par+'_i'), getattr(row, par+'_f'),
+                    ]
+                    if not np.isnan(data_subj).any():
+                        si = i/len(df_visit)
+                        ax[visit+par].plot(
+                            t, data_subj, '-', 
+                            label=row.subject, marker=mark[int(i+1)], 
+                            markersize=markersize, color=color(si))
+        plot_file = os.path.join(src, 'Figures', '_diurnal_function.png')
+        savefig(fig, plot_file)
+
+
+# Bar charts of the values per visit: one file per parameter, pages 
+# with several parameters each, or both.
+BAR_CHARTS = ['files', 'pages', 'both']
+
+# Rows and columns of the bar charts on each page
+PAGE_LAYOUT = (4, 3)
+
+
+def bar_chart_mode(mode=None):
+    # If not provided, the mode is read from the environment variable
+    # TRISTAN_BAR_CHARTS (default 'files').
+    if mode is None:
+        mode = os.environ.get('TRISTAN_BAR_CHARTS', 'files')
+    if mode not in BAR_CHARTS:
+        raise ValueError(
+            f"Bar chart mode {mode} is not recognised. Options are "
+            f"{BAR_CHARTS}."
+        )
+    return mode
+
+
+def _bar_chart_values(output, params, visits, subjects):
+    # Values as an array of parameters x visits x subjects, from a 
+    # single pivot. Missing values are NaN, and where a subject has 
+    # more than one value for a parameter and visit the first is used.
+    df = output[output.visit.isin(visits)]
+    df = df.drop_duplicates(['parameter', 'visit', 'subject'])
+    wide = df.pivot(index='parameter', columns=['visit', 'subject'], 
+                    values='value')
+    cols = pd.MultiIndex.from_product([visits, subjects])
+    wide = wide.reindex(index=params, columns=cols)
+    return wide.values.reshape(len(params), len(visits), len(subjects))
+
+
+def _bar_chart(ax, par, unit, values, visits, subjects, ylim={}, 
+               labels=True):
+    # Bars of the values of each subject (visits x subjects), with 
+    # the value above each bar if labels is True.
+    x = np.arange(len(subjects))  # the label locations
+    width = 0.25  # the width of the bars
+    colors = {visits[0]:'slateblue', visits[1]:'coral'}
+    for multiplier, visit in enumerate(visits):
+        offset = width * multiplier
+        rects = ax.bar(
+            x + offset, values[multiplier], width, label=visit, 
+            color=colors[visit])
+        if labels:
+            ax.bar_label(rects, padding=3)
+
+    # Add some text for labels, title and custom x-axis tick labels, etc.
+    ax.set_ylabel(par + ' (' + str(unit) + ')')
+    ax.set_title('Values per visit ' + par)
+    ax.set_xticks(x + width, subjects)
+    ax.legend(loc='upper left', ncols=2)
+    if par in ylim:
+        ax.set_ylim(ylim[par][0], ylim[par][1])
+
+
+def _bar_chart_pages(path, struct, charts, visits, subjects, ylim={}):
+    # Bar charts of several parameters on each page, saved as 
+    # _plots_<struct>_<page>.png. charts is a list of (parameter, 
+    # unit, values). Values are not printed above the bars.
+    rows, cols = PAGE_LAYOUT
+    for page, start in enumerate(range(0, len(charts), rows*cols)):
+        with figure(rows, cols, figsize=(5*cols, 3.5*rows), 
+                    layout='constrained', squeeze=False) as (fig, axes):
+            axes = axes.ravel()
+            for ax, (par, unit, values) in zip(axes, 
+                                               charts[start:start+rows*cols]):
+                _bar_chart(ax, par, unit, values, visits, subjects, ylim, 
+                           labels=False)
+                ax.tick_params(axis='x', labelrotation=90, labelsize=6)
+                if ax is not axes[0]:
+                    ax.get_legend().remove()
+            for ax in axes[len(charts[start:start+rows*cols]):]:
+                ax.set_axis_off()
+            plot_file = os.path.join(
+                path, '_plots_' + struct + '_' + str(page+1) + '.png'
+            )
+            savefig(fig, plot_file)
 
 
-def create_bar_chart(resultsfolder, ylim={}):
+def create_bar_chart(resultsfolder, ylim={}, session=None, mode=None):
 
+    # Bar charts of the values of each parameter per subject and 
+    # visit. mode is 'files' for one file per parameter 
+    # (_plot_<par>_<struct>.png), 'pages' for several parameters per 
+    # file (see _bar_chart_pages) or 'both' (see bar_chart_mode).
+
+    mode = bar_chart_mode(mode)
     path = os.path.join(resultsfolder, 'Figures')
     if not os.path.exists(path):
         os.makedirs(path)
 
-    output_file = os.path.join(resultsfolder, 'all_results')
-    dmr = pydmr.read(output_file, format='table')
-    output = pd.DataFrame(dmr['pars'], columns=['subject', 'visit', 'parameter', 'value'])
+    session = results_session.get(resultsfolder, session)
+    output = session.results().drop(columns='sdev')
 
-    output['group'] = calc.lookup(resultsfolder, output.parameter.values, 'group')
-    output['description'] = calc.lookup(resultsfolder, output.parameter.values, 'description')
-    output['unit'] = calc.lookup(resultsfolder, output.parameter.values, 'unit') 
+    params = output.parameter.unique()
+    group = session.lookup(params, 'group')
+    unit = session.lookup(params, 'unit')
     visits = output.visit[output.visit!='change (%)'].unique()
+    subjects = output['subject'].unique()
+    values = _bar_chart_values(output, params, visits, subjects)
 
     # Create bar charts for each parameter
-    subjects = output['subject'].unique()
-    structures = output['group'].unique()
-    for struct in structures:
-        df_struct = output[output.group==struct]
-        for par in df_struct['parameter'].unique():
+    for struct in pd.unique(np.array(group, dtype=object)):
+        charts = []
+        for i, par in enumerate(params):
+            if group[i] != struct:
+                continue
             if par == 'Kbh':
                 # For some reason the file with kbh is not written
                 # when Kbh is already saved. Same for Khe - not written 
                 # because khe is written first. Putting in this hack as 
                 # Kbh is not of interest.
                 continue
-            df = df_struct[df_struct.parameter==par]
-            bar_chart = {}
-            for visit in visits:
-                df_visit = df[df.visit==visit]
-                bar_chart[visit] = []
-                for s in subjects:
-                    df_visit_subj = df_visit[df_visit.subject==s]
-                    if df_visit_subj.empty:
-                        val = np.nan
-                    else:
-                        val = df_visit_subj['value'].values[0]
-                    bar_chart[visit].append(val)
-            x = np.arange(len(subjects))  # the label locations
-            width = 0.25  # the width of the bars
-            multiplier = 0
-
-            fig, ax = plt.subplots(layout='constrained')
-            colors = {visits[0]:'slateblue', visits[1]:'coral'}
-            for attribute, measurement in bar_chart.items():
-                offset = width * multiplier
-                if measurement != np.nan:
-                    rects = ax.bar(
-                        x + offset, measurement, width, label=attribute, 
-                        color=colors[attribute])
-                    ax.bar_label(rects, padding=3)
-                multiplier += 1
-
-            # Add some text for labels, title and custom x-axis tick labels, etc.
-            units = df.unit.unique()[0]
-            ax.set_ylabel(par + ' (' + str(units) + ')')
-            ax.set_title('Values per visit ' + par)
-            ax.set_xticks(x + width, subjects)
-            ax.legend(loc='upper left', ncols=2)
-            if par in ylim:
-                ax.set_ylim(ylim[par][0], ylim[par][1])
-            plot_file = os.path.join(
-                path, '_plot_' + par + '_' + struct + '.png'
-            )
-            plt.savefig(fname=plot_file)
-            plt.close()
\ No newline at end of file
+            charts.append((par, unit[i], values[i]))
+        if mode in ['files', 'both']:
+            for par, u, v in charts:
+                with figure(layout='constrained') as (fig, ax):
+                    _bar_chart(ax, par, u, v, visits, subjects, ylim)
+                    plot_file = os.path.join(
+                        path, '_plot_' + par + '_' + struct + '.png'
+                    )
+                    savefig(fig, plot_file)
+        if mode in ['pages', 'both']:
+            _bar_chart_pages(path, struct, charts, visits, subjects, ylim)
+
+
+# Time windows of the per-subject plots, as the duration after the 
+# bolus arrival time (sec). Each window starts 20 sec before the 
+# bolus arrival.
+WINDOWS = {
+    'win1': 1200,
+    'win2': 600,
+    'win3': 160,
+}
+
+
+def fit_windows(BAT, windows=None):
+    # x-axis limits (sec) of the windows around a bolus arrival time
+    if windows is None:
+        windows = WINDOWS
+    return {w: [BAT-20, BAT+dur] for w, dur in windows.items()}
+
+
+# Report variants of the per-subject plots (see fit), which are shown
+# in the case notes of the reports at REPORT_WIDTH (in). They are
+# rendered at REPORT_PPI pixels per inch of the report, with a palette
+# of REPORT_COLORS, and at a lower resolution (down to MIN_PPI) if
+# needed to stay within their share of the size budget.
+REPORT_WIDTH = 4.5
+REPORT_PPI = 150
+MIN_PPI = 60
+REPORT_COLORS = 256
+
+
+def report_budget(budget=None):
+    # Size budget (MB) of the report variants of all per-subject plots
+    # of an experiment. If not provided, this is read from the
+    # environment variable TRISTAN_REPORT_BUDGET (default 20).
+    if budget is None:
+        budget = float(os.environ.get('TRISTAN_REPORT_BUDGET', 20) or 20)
+    if budget <= 0:
+        raise ValueError("The size budget of the reports must be positive.")
+    return budget
+
+
+def report_file(file):
+    # Report variant of a plot saved in file
+    path, name = os.path.split(file)
+    return os.path.join(path, 'Report', name)
+
+
+def save_report_figure(fig, file, budget):
+
+    # Save a compressed variant of fig in file, no larger than budget
+    # (bytes) unless this needs a resolution below MIN_PPI. The size
+    # scales with the number of pixels, so each new attempt lowers
+    # the resolution by the square root of the excess.
+
+    ppi = REPORT_PPI
+    while True:
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png', 
+                    dpi=ppi*REPORT_WIDTH/fig.get_figwidth())
+        buf.seek(0)
+        img = Image.open(buf).convert('RGB').quantize(REPORT_COLORS)
+        out = io.BytesIO()
+        img.save(out, format='png', optimize=True)
+        size = out.tell()
+        if size <= budget or ppi == MIN_PPI:
+            break
+        ppi = max(MIN_PPI, ppi*min(0.9, 0.98*np.sqrt(budget/size)))
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    with open(file, 'wb') as f:
+        f.write(out.getvalue())
+
+
+def _fit_curves(model, xdata, ydata):
+    # Signal curves of a trained model and the default x-axis limits 
+    # of the signal plots, as in model.plot.
+    t, cb, C = model.conc(sum=False)
+    if len(xdata) == 2:
+        sig = model.predict((t, t))
+        curves = [
+            (xdata[0], ydata[0], t, sig[0], [t[0], t[-1]]),
+            (xdata[1], ydata[1], t, sig[1], [t[0], t[-1]]),
+        ]
+    else:
+        ta1 = t[t <= xdata[1][0]]
+        ta2 = t[(t > xdata[1][0]) & (t <= xdata[1][-1])]
+        tl1 = t[t <= xdata[3][0]]
+        tl2 = t[(t > xdata[3][0]) & (t <= xdata[3][-1])]
+        sig = model.predict((ta1, ta2, tl1, tl2))
+        curves = [
+            (np.concatenate(xdata[:2]), np.concatenate(ydata[:2]), 
+             np.concatenate((ta1, ta2)), np.concatenate(sig[:2]), 
+             [0, ta2[-1]]),
+            (np.concatenate(xdata[2:]), np.concatenate(ydata[2:]), 
+             np.concatenate((tl1, tl2)), np.concatenate(sig[2:]), 
+             [0, tl2[-1]]),
+        ]
+    return t, cb, C, curves
+
+
+def _clip(x, xlim):
+    # Range of the points of an increasing x that are inside xlim,
+    # with the nearest point on either side so that lines run to the
+    # edges of the axis.
+    start = max(np.searchsorted(x, xlim[0], side='left') - 1, 0)
+    stop = min(np.searchsorted(x, xlim[1], side='right') + 1, len(x))
+    return slice(start, stop)
+
+
+def decimate(x, y, xlim, pixels, exact=False):
+
+    # Points of the curve (x, y) that are drawn within xlim on an axis
+    # that is pixels wide. Points outside xlim are left out (see
+    # _clip). Unless exact is True, only the first, last, smallest and
+    # largest value in each pixel column are kept, in their original
+    # order, so that a solid line looks the same but takes a time
+    # proportional to the width of the axis to draw. Markers and
+    # dashed lines, whose pattern follows the length of the line, need
+    # all points.
+
+    x, y = np.asarray(x), np.asarray(y)
+    if len(x) < 2 or np.any(np.diff(x) < 0):
+        return x, y
+    window = _clip(x, xlim)
+    x, y = x[window], y[window]
+    if exact or len(x) <= 4*pixels:
+        return x, y
+
+    # Pixel columns are increasing, so each column is one run of 
+    # points. Sorting by column, then value, puts the smallest and 
+    # largest value of each column at the start and end of its run.
+    col = np.floor(pixels*(x - xlim[0])/(xlim[1] - xlim[0]))
+    col = np.clip(col, -1, pixels).astype(int)
+    first = np.flatnonzero(np.diff(col, prepend=col[0]-1))
+    last = np.append(first[1:], len(col)) - 1
+    order = np.lexsort((y, col))
+    keep = np.unique(np.concatenate(
+        (first, last, order[first], order[last])))
+    return x[keep], y[keep]
+
+
+def _decimate(axes, lims):
+
+    # Clip and decimate all lines on each axis for the x-axis limits
+    # (see decimate). The full data are kept on the lines as _full.
+
+    for ax, lim in zip(axes, lims):
+        ax.set_xlim(lim)
+        pixels = int(np.ceil(ax.get_window_extent().width))
+        for line in ax.get_lines():
+            if not hasattr(line, '_full'):
+                line._full = (line.get_xdata(), line.get_ydata())
+            exact = line.get_linestyle() != '-'
+            line.set_data(*decimate(*line._full, lim, pixels, exact))
+
+
+def fit(model, xdata, ydata, file, xlims, ref=None, budget=None):
+
+    # Plot a trained AortaLiver or AortaLiver2scan model against the 
+    # data, with the same layout as model.plot. The curves are 
+    # computed and plotted only once, and the figure is saved once 
+    # for each entry in xlims by changing the x-axis limits. Only the 
+    # points needed to draw each window are drawn (see decimate). 
+    # xlims maps a suffix of the file name to x-axis limits in sec, or 
+    # None for the full time course. If a budget (bytes) is given, a report 
+    # variant of the full time course is saved as well (see 
+    # save_report_figure). Returns the list of saved files.
+
+    t, cb, C, curves = _fit_curves(model, xdata, ydata)
+
+    with figure(2, 2, figsize=(10, 8)) as (fig, axes):
+        (ax1, ax2), (ax3, ax4) = axes
+        fig.subplots_adjust(wspace=0.3)
+
+        # Signals
+        colors = [['lightcoral', 'darkred'], ['cornflowerblue', 'darkblue']]
+        for i, ax in enumerate([ax1, ax3]):
+            x, y, tfit, sig, _ = curves[i]
+            ax.set(xlabel='Time (min)', ylabel='MR Signal (a.u.)')
+            ax.plot(x/60, y, marker='o', color=colors[i][0], 
+                    label='fitted data', linestyle='None')
+            ax.plot(tfit/60, sig, linestyle='-', color=colors[i][1], 
+                    linewidth=3.0, label='fit')
+            if ref is not None:
+                ax.plot(np.array(ref[i][0])/60, ref[i][1], color='black',
+                        marker='D', linestyle='None', label='Test data')
+            ax.legend()
+
+        # Aorta concentration
+        ax2.set(xlabel='Time (min)', ylabel='Concentration (mM)')
+        ax2.plot(t/60, 0*t, color='gray')
+        ax2.plot(t/60, 1000*cb, linestyle='-', color='darkred', 
+                 linewidth=2.0, label='Aorta')
+        ax2.legend()
+
+        # Liver concentration
+        color = 'darkblue'
+        ax4.set(xlabel='Time (min)', ylabel='Tissue concentration (mM)')
+        ax4.plot(t/60, 0*t, color='gray')
+        if 'IC' in model.kinetics:
+            ax4.plot(t/60, 1000*C[0, :], linestyle='-.', color=color, 
+                     linewidth=2.0, label='Extracellular')
+            ax4.plot(t/60, 1000*C[1, :], linestyle='--', color=color, 
+                     linewidth=2.0, label='Hepatocytes')
+            ax4.plot(t/60, 1000*(C[0, :]+C[1, :]), linestyle='-', 
+                     color=color, linewidth=2.0, label='Tissue')
+        else:
+            ax4.plot(t/60, 1000*C, linestyle='-', color=color, 
+                     linewidth=2.0, label='Tissue')
+        ax4.legend()
+
+        # Fix the y-axis limits to those of the full curves, as only 
+        # the points inside each window are drawn.
+        for ax in axes.flat:
+            ax.set_ylim(ax.get_ylim())
+
+        # Save one file per window
+        files = []
+        for suffix, xlim in xlims.items():
+            if xlim is None:
+                tlim = [t[0], t[-1]]
+                lims = [curves[0][4], tlim, curves[1][4], tlim]
+            else:
+                lims = [xlim] * 4
+            lims = [np.array(lim)/60 for lim in lims]
+            _decimate([ax1, ax2, ax3, ax4], lims)
+            files.append(file + suffix + '.png')
+            savefig(fig, files[-1])
+            if xlim is None and budget is not None:
+                files.append(report_file(files[-1]))
+                save_report_figure(fig, files[-1], budget)
+        return files
@@ -1,6 +1,15 @@
 import os
+import shutil
+import pickle
+import tempfile
+from contextlib import contextmanager
+
 import pandas as pd
 import miblab
+from pylatex.base_classes.containers import Fragment
+from pylatex.utils import NoEscape
+
+from methods import tools, stages, plot
 
 
 ONESCAN = 'results (one scan)'
@@ -8,6 +17,137 @@ TWOSCAN = 'results (two scans)'
 VART = 'results (one scan - variable tacq'
 
 
+@contextmanager
+def _workdir():
+    # miblab.Report writes its temporary files to the working 
+    # directory, so reports built at the same time (for instance by 
+    # concurrent studies) would overwrite each other's files. Each 
+    # report is therefore built in its own temporary directory.
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+# The LaTeX source of each section is saved in the source folder of
+# the report, under a fingerprint of the figures and tables it shows
+# (by content), their captions and the version of miblab. A section
+# is only rendered again when one of these has changed, and the pdf
+# is only compiled again when the source of the report or one of its
+# figures has changed.
+SECTIONS = 'sections'
+
+
+def workers(n=None):
+    # Number of reports built at the same time (see build). If not
+    # provided, this is read from the environment variable
+    # TRISTAN_REPORT_WORKERS, falling back to the number of workers
+    # used for the calculations.
+    if n is None:
+        n = os.environ.get('TRISTAN_REPORT_WORKERS')
+        n = None if n in [None, ''] else int(n)
+    return tools.workers(n)
+
+
+def _build(func, kwargs):
+    func(**kwargs)
+
+
+def build(reports, n=None):
+    # Build several reports at the same time. reports is a list of
+    # (function, keyword arguments), for instance
+    # (all_results, {'resultspath': path, 'filename': 'report'}).
+    tools.pmap(_build, reports, workers(n))
+
+
+class _Recorder:
+
+    # Takes the place of the report in a section function, so that the
+    # figures and tables of the section are known before it is
+    # rendered.
+
+    def __init__(self):
+        self.calls = []
+
+    def clearpage(self):
+        self.calls.append(('clearpage', (), {}))
+
+    def chapter(self, *args, **kwargs):
+        self.calls.append(('chapter', args, kwargs))
+
+    def section(self, *args, **kwargs):
+        self.calls.append(('section', args, kwargs))
+
+    def subsection(self, *args, **kwargs):
+        self.calls.append(('subsection', args, kwargs))
+
+    def figure(self, *args, **kwargs):
+        self.calls.append(('figure', args, kwargs))
+
+    def table(self, *args, **kwargs):
+        self.calls.append(('table', args, kwargs))
+
+
+class _Sections:
+
+    # Sections of a report, rendered or reused from the source folder.
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.path = os.path.join(doc.folder, doc.filename + '_source')
+        self.fingerprints = []
+
+    def add(self, section, *args):
+        rec = _Recorder()
+        section(rec, *args)
+        if rec.calls == []:
+            return
+        # Paths of existing files are fingerprinted by their content
+        fp = stages.fingerprint(rec.calls, stages.source(miblab.Report))
+        file = os.path.join(self.path, SECTIONS, fp + '.pkl')
+        if os.path.exists(file):
+            with open(file, 'rb') as f:
+                tex, packages = pickle.load(f)
+        else:
+            frag = Fragment()
+            for name, args, kwargs in rec.calls:
+                getattr(miblab.Report, name)(frag, *args, **kwargs)
+            tex = frag.dumps()
+            frag._propagate_packages()
+            packages = list(frag.packages)
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            tmp = file + '.' + str(os.getpid()) + '.tmp'
+            with open(tmp, 'wb') as f:
+                pickle.dump((tex, packages), f)
+            os.replace(tmp, file)
+        self.doc.append(NoEscape(tex))
+        for p in packages:
+            self.doc.packages.add(p)
+        self.fingerprints.append(fp)
+
+    def build(self):
+        # Compile the pdf unless the same source has been compiled
+        # before, then remove the sections that are no longer used.
+        doc = self.doc
+        fp = stages.fingerprint(doc.dumps(), self.fingerprints)
+        pdf = os.path.join(doc.folder, doc.filename + '.pdf')
+        uptodate = stages.uptodate(self.path, doc.filename, fp)
+        if uptodate and not stages.forced():
+            print('Up to date: ', doc.filename)
+        else:
+            doc.build()
+            stages.record(self.path, doc.filename, fp, [pdf])
+        used = set(f + '.pkl' for f in self.fingerprints)
+        folder = os.path.join(self.path, SECTIONS)
+        for file in os.listdir(folder):
+            if file not in used:
+                os.remove(os.path.join(folder, file))
+
+
 def key_results(
         resultspath, 
         filename,
@@ -18,21 +158,25 @@ def key_results(
 
     print('Creating report..')
 
-    # Cover and title pages
-    doc = miblab.Report(
-        resultspath,
-        filename,
-        title = title,
-        subtitle = subtitle,
-        subject = subject,
-    )
+    resultspath = os.path.abspath(resultspath)
+    with _workdir():
+
+        # Cover and title pages
+        doc = miblab.Report(
+            resultspath,
+            filename,
+            title = title,
+            subtitle = subtitle,
+            subject = subject,
+        )
+        sections = _Sections(doc)
 
-    folder = TWOSCAN
-    doc.chapter('Key results')
-    section_summary(doc, os.path.join(resultspath, folder))
-    section_biomarkers(doc, os.path.join(resultspath, folder))
+        folder = TWOSCAN
+        doc.chapter('Key results')
+        sections.add(section_summary, os.path.join(resultspath, folder))
+        sections.add(section_biomarkers, os.path.join(resultspath, folder))
 
-    doc.build()
+        sections.build()
 
 
 def all_results(
@@ -45,36 +189,40 @@ def all_results(
 
     print('Creating report..')
 
-    # Cover and title pages
-    doc = miblab.Report(
-        resultspath,
-        filename,
-        title = title,
-        subtitle = subtitle,
-        subject = subject,
-    )
+    resultspath = os.path.abspath(resultspath)
+    with _workdir():
 
-    # Two-scan results
-    folder = TWOSCAN
-    doc.chapter('Two-scan results')
-    section_summary(doc, os.path.join(resultspath, folder))
-    section_biomarkers(doc, os.path.join(resultspath, folder))
-    section_reference(doc, os.path.join(resultspath, folder))
-    section_case_notes(doc, os.path.join(resultspath, folder))
+        # Cover and title pages
+        doc = miblab.Report(
+            resultspath,
+            filename,
+            title = title,
+            subtitle = subtitle,
+            subject = subject,
+        )
+        sections = _Sections(doc)
+
+        # Two-scan results
+        folder = TWOSCAN
+        doc.chapter('Two-scan results')
+        sections.add(section_summary, os.path.join(resultspath, folder))
+        sections.add(section_biomarkers, os.path.join(resultspath, folder))
+        sections.add(section_reference, os.path.join(resultspath, folder))
+        sections.add(section_case_notes, os.path.join(resultspath, folder))
 
-    # One-scan results
-    folder = ONESCAN
-    doc.chapter('One-scan results')
-    section_summary(doc, os.path.join(resultspath, folder))
-    section_biomarkers(doc, os.path.join(resultspath, folder))
-    section_case_notes(doc, os.path.join(resultspath, folder))
+        # One-scan results
+        folder = ONESCAN
+        doc.chapter('One-scan results')
+        sections.add(section_summary, os.path.join(resultspath, folder))
+        sections.add(section_biomarkers, os.path.join(resultspath, folder))
+        sections.add(section_case_notes, os.path.join(resultspath, folder))
 
-    # Secondary results
-    doc.chapter('Secondary results')
-    section_diurnal(doc, os.path.join(resultspath, TWOSCAN))
-    section_acqtime(doc, resultspath)
+        # Secondary results
+        doc.chapter('Secondary results')
+        sections.add(section_diurnal, os.path.join(resultspath, TWOSCAN))
+        sections.add(section_acqtime, resultspath)
 
-    doc.build()
+        sections.build()
 
 
 def primary_results(
@@ -87,26 +235,30 @@ def primary_results(
 
     print('Creating report..')
 
-    # Cover and title pages
-    doc = miblab.Report(
-        resultspath,
-        filename,
-        title = title,
-        subtitle = subtitle,
-        subject = subject,
-    )
+    resultspath = os.path.abspath(resultspath)
+    with _workdir():
 
-    # Two-scan results
-    doc.chapter('Main results')
-    section_summary(doc, resultspath)
-    section_biomarkers(doc, resultspath)
-    section_case_notes(doc, resultspath)
+        # Cover and title pages
+        doc = miblab.Report(
+            resultspath,
+            filename,
+            title = title,
+            subtitle = subtitle,
+            subject = subject,
+        )
+        sections = _Sections(doc)
 
-    # Secondary results
-    doc.chapter('Secondary results')
-    section_diurnal(doc, resultspath)
+        # Two-scan results
+        doc.chapter('Main results')
+        sections.add(section_summary, resultspath)
+        sections.add(section_biomarkers, resultspath)
+        sections.add(section_case_notes, resultspath)
 
-    doc.build()
+        # Secondary results
+        doc.chapter('Secondary results')
+        sections.add(section_diurnal, resultspath)
+
+        sections.build()
 
 
 def section_diurnal(doc: miblab.Report, results):
@@ -269,9 +421,19 @@ def section_biomarkers(doc: miblab.Report, folder):
 
 
 
+def _case_plot(folder, name):
+    # Report variant of a per-subject plot (see plot.fit), or the plot
+    # itself if there is none.
+    file = os.path.join(folder, 'Plots', name)
+    if os.path.exists(plot.report_file(file)):
+        return plot.report_file(file)
+    return file
+
+
 def section_case_notes(doc: miblab.Report, folder):
 
     doc.section('Case notes', clearpage=True)
+    width = str(plot.REPORT_WIDTH) + 'in'
 
     # Get data
     file = os.path.join(folder, 'Analysis', 'parameters_rep.csv')
@@ -285,20 +447,22 @@ def section_case_notes(doc: miblab.Report, folder):
         doc.subsection('Subject ' + subj)
 
         # Images
-        fig = os.path.join(folder, 'Plots', subj +'_control.png')
+        fig = _case_plot(folder, subj + '_control.png')
         caption = (
             "Signal-time curves for subject "+subj+" at the "
             "control visit."
         )
-        doc.figure(fig, width='4.5in', caption=caption)
+        # Plots are not available if they are switched off
+        if os.path.exists(fig):
+            doc.figure(fig, width=width, caption=caption)
 
-        fig = os.path.join(folder,  'Plots', subj +'_drug.png')
+        fig = _case_plot(folder, subj + '_drug.png')
         caption = (
             "Signal-time curves for subject "+subj+" at "
             "the treatment visit."
         )
         if os.path.exists(fig):
-            doc.figure(fig, width='4.5in', caption=caption)
+            doc.figure(fig, width=width, caption=caption)
 
         # Tables
         doc.clearpage()
@@ -0,0 +1,73 @@
+import os
+
+import pandas as pd
+
+from methods import store
+
+
+class Session:
+
+    # Results of one experiment, loaded once by master.run and passed
+    # to each of the analysis stages so they do not need to re-read
+    # them from disk. Tables derived by a stage (Analysis/<name>.csv)
+    # are kept in memory as well as saved. Tables that are not in
+    # memory, for instance because the stage that creates them was
+    # up to date, are read from the csv file on first use.
+    #
+    # Tables are returned as copies so that stages can modify them.
+
+    def __init__(self, path):
+        self.path = path
+        self._results = None
+        self._tables = {}
+
+    def __repr__(self):
+        # Used in the fingerprints of the stages (see stages.run)
+        return 'Session(' + repr(self.path) + ')'
+
+    def results(self):
+        # Results of all fits (see store.read)
+        if self._results is None:
+            self._results = store.read(self.path)
+        return self._results.copy()
+
+    def parameters(self):
+        # Parameter metadata, indexed by parameter (see store.metadata)
+        return store.metadata(self.path)
+
+    def lookup(self, params, prop):
+        # Property of each of a list of parameters (see store.lookup)
+        return store.lookup(self.path, params, prop)
+
+    def file(self, name):
+        return os.path.join(self.path, 'Analysis', name + '.csv')
+
+    def table(self, name, **kwargs):
+        # Derived table. Keyword arguments are passed to pd.read_csv
+        # if the table needs to be read from file. Values are read 
+        # back exactly as they were saved, so that the result does 
+        # not depend on whether the table was in memory.
+        if name not in self._tables:
+            kwargs.setdefault('float_precision', 'round_trip')
+            self._tables[name] = pd.read_csv(self.file(name), **kwargs)
+        return self._tables[name].copy()
+
+    def save(self, name, df, dtype=None, **kwargs):
+        # Keep a derived table in memory and save it as csv. dtype are
+        # the types of columns that change when the csv file is read.
+        # Keyword arguments are passed to df.to_csv.
+        file = self.file(name)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        df.to_csv(file, **kwargs)
+        if dtype is None:
+            self._tables[name] = df.copy()
+        else:
+            self._tables[name] = df.astype(dtype)
+
+
+def get(path, session=None):
+    # Session to use in a stage called with the results path and an
+    # optional session.
+    if session is None:
+        return Session(path)
+    return session
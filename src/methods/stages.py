@@ -0,0 +1,191 @@
+import os
+import sys
+import json
+import inspect
+import hashlib
+from importlib.metadata import version
+
+import numpy as np
+
+from methods import tools
+
+
+# Manifest file with the fingerprints and outputs of completed stages.
+MANIFEST = '.stages.json'
+
+
+def _update(h, x):
+    if isinstance(x, dict):
+        for k in sorted(x, key=str):
+            h.update(repr(k).encode())
+            _update(h, x[k])
+    elif isinstance(x, (list, tuple)):
+        h.update(str(len(x)).encode())
+        for v in x:
+            _update(h, v)
+    elif isinstance(x, np.ndarray):
+        h.update(str(x.dtype).encode() + str(x.shape).encode())
+        h.update(np.ascontiguousarray(x).tobytes())
+    elif isinstance(x, str) and os.path.isfile(x):
+        # Files enter with their content
+        with open(x, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    else:
+        h.update(repr(x).encode())
+    h.update(b';')
+
+
+def fingerprint(*inputs):
+    # Hash of a list of inputs. Existing files are hashed by content,
+    # arrays by their values and anything else by its repr.
+    h = hashlib.sha256()
+    for x in inputs:
+        _update(h, x)
+    return h.hexdigest()
+
+
+def _imports(module):
+    # Modules of this package used by a module: imported modules, and
+    # the modules of imported functions and classes.
+    package = __name__.rpartition('.')[0] + '.'
+    names = set()
+    for obj in vars(module).values():
+        if inspect.ismodule(obj):
+            names.add(obj.__name__)
+        elif inspect.isfunction(obj) or inspect.isclass(obj):
+            names.add(obj.__module__)
+    return [sys.modules[n] for n in sorted(names) 
+            if n.startswith(package) and n in sys.modules]
+
+
+def source(*objects):
+    # Source files of functions or modules, and of the modules of this
+    # package that they use directly or through other modules, so 
+    # that a stage is rerun when the code that produces it has 
+    # changed.
+    files = [inspect.getsourcefile(obj) for obj in objects]
+    todo = [inspect.getmodule(obj) for obj in objects]
+    done = set()
+    while todo:
+        module = todo.pop()
+        if module is None or module.__name__ in done:
+            continue
+        done.add(module.__name__)
+        todo += _imports(module)
+    package = __name__.rpartition('.')[0] + '.'
+    for n in sorted(done):
+        file = inspect.getsourcefile(sys.modules[n])
+        if n.startswith(package) and file not in files:
+            files.append(file)
+    return files + [version('dcmri')]
+
+
+def _read(path):
+    file = os.path.join(path, MANIFEST)
+    if not os.path.exists(file):
+        return {}
+    with open(file, 'r') as f:
+        return json.load(f)
+
+
+def _write(path, manifest):
+    os.makedirs(path, exist_ok=True)
+    file = os.path.join(path, MANIFEST)
+    tmp = file + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, file)
+
+
+def _exists(file):
+    # .dmr files are saved as .dmr.zip
+    return os.path.exists(file) or os.path.exists(file + '.zip')
+
+
+def _uptodate(entry, fp):
+    if entry is None:
+        return False
+    if entry['inputs'] != fp:
+        return False
+    return all(_exists(f) for f in entry['outputs'])
+
+
+def uptodate(path, name, fp):
+    # True if the stage was completed with the same inputs and all of
+    # its outputs still exist.
+    return _uptodate(_read(path).get(name), fp)
+
+
+def record(path, name, fp, outputs):
+    manifest = _read(path)
+    manifest[name] = {'inputs': fp, 'outputs': list(outputs)}
+    _write(path, manifest)
+
+
+def forget(path):
+    # Remove all records so that every stage is rerun.
+    file = os.path.join(path, MANIFEST)
+    if os.path.exists(file):
+        os.remove(file)
+
+
+def _files(path):
+    files = {}
+    for root, _, names in os.walk(path):
+        for n in names:
+            if n == MANIFEST or n.endswith('.tmp'):
+                continue
+            file = os.path.join(root, n)
+            files[file] = os.stat(file).st_mtime_ns
+    return files
+
+
+def forced(force=False):
+    # Stages can also be forced with the environment variable 
+    # TRISTAN_FORCE.
+    return force or os.environ.get('TRISTAN_FORCE', '0') not in ['', '0']
+
+
+def run(path, name, func, *args, inputs=[], force=False, **kwargs):
+    # Run func(*args, **kwargs) unless it has already been run with
+    # the same inputs, arguments and code. The files created or
+    # modified under path are recorded as the outputs of the stage.
+    force = forced(force)
+    fp = fingerprint(inputs, source(func), args, kwargs)
+    if not force and uptodate(path, name, fp):
+        print('Up to date: ', name)
+        return False
+    before = _files(path)
+    func(*args, **kwargs)
+    after = _files(path)
+    outputs = [f for f, t in after.items() if before.get(f) != t]
+    record(path, name, fp, outputs)
+    return True
+
+
+def pmap(path, func, tasks, names, inputs, n=None, force=False):
+    # Apply func to each tuple of arguments in tasks as in tools.pmap, 
+    # but skip tasks that are up to date. Each task has a name and 
+    # a list of inputs for its fingerprint. func must return the 
+    # output file of the task, or a list of output files. The 
+    # outputs of all tasks are returned in the order of the tasks.
+    force = forced(force)
+    src = source(func)
+    fps = [fingerprint(x, src) for x in inputs]
+    manifest = _read(path)
+    todo = [
+        i for i in range(len(tasks)) 
+        if force or not _uptodate(manifest.get(names[i]), fps[i])
+    ]
+    if len(todo) < len(tasks):
+        print('Up to date: ', len(tasks)-len(todo), 'of', len(tasks), 
+              'tasks')
+    results = tools.pmap(func, [tasks[i] for i in todo], n)
+    manifest = _read(path)
+    for i, outputs in zip(todo, results):
+        if isinstance(outputs, str):
+            outputs = [outputs]
+        manifest[names[i]] = {'inputs': fps[i], 'outputs': outputs}
+    _write(path, manifest)
+    return [manifest[name]['outputs'] for name in names]
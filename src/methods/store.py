@@ -0,0 +1,196 @@
+import os
+
+import pandas as pd
+import pydmr
+
+from methods import tools, stages, metrics
+
+
+# Results of an experiment are stored in two Parquet files: one row
+# per subject, visit and parameter, and one row per parameter with
+# its metadata.
+RESULTS = 'all_results.parquet'
+PARAMETERS = 'all_results_parameters.parquet'
+
+COLUMNS = ['subject', 'visit', 'parameter', 'value', 'sdev']
+METADATA = ['parameter', 'description', 'unit', 'type', 'group', 'label']
+
+
+def dmr_export(export=None):
+    # If export is not provided, the results are also exported as
+    # all_results.dmr unless the environment variable TRISTAN_NO_DMR
+    # is set.
+    if export is None:
+        return os.environ.get('TRISTAN_NO_DMR', '0') in ['', '0']
+    return export
+
+
+def _write(df, file):
+    # Write to a temporary file first so that concurrent readers
+    # never see a partially written file.
+    tmp = file + '.' + str(os.getpid()) + '.tmp'
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, file)
+    return file
+
+
+def _table(subj, study, pars):
+    # Rows of the results of one fit, with the metadata of each
+    # parameter. pars is a dictionary as returned by 
+    # tools.export_params.
+    rows = []
+    for key, val in pars.items():
+        aorta = key in tools.AORTA_PARS or metrics.aorta(key)
+        group = 'MRI - aorta' if aorta else 'MRI - liver'
+        rows.append([
+            subj, study, key, val[1], val[3],
+            val[0], val[2], 'float', group, 
+            tools.LABEL.get(key, metrics.label(key)),
+        ])
+    return pd.DataFrame(rows, columns=COLUMNS + METADATA[1:])
+
+
+def _part(path, subj, study):
+    return os.path.join(path, subj + '_' + study + '.parquet')
+
+
+def append(path, subj, study, pars):
+
+    # Add the results of one fit to the store, as a separate part so
+    # that workers can append at the same time. pars is a dictionary
+    # as returned by tools.export_params. Returns the part file.
+
+    os.makedirs(path, exist_ok=True)
+    return _write(_table(subj, study, pars), _part(path, subj, study))
+
+
+def update(path, subj, study, pars):
+
+    # Add parameters to the results of one fit saved by append, or
+    # replace their values. Existing parameters keep their place and
+    # new ones are added at the end. Returns the part file.
+
+    file = _part(path, subj, study)
+    old = pd.read_parquet(file)
+    new = _table(subj, study, pars)
+    order = list(old.parameter)
+    order += [p for p in new.parameter if p not in set(order)]
+    df = pd.concat([old[~old.parameter.isin(new.parameter)], new])
+    df = df.set_index('parameter').loc[order].reset_index()
+    return _write(df[old.columns], file)
+
+
+def concat(parts, path):
+
+    # Combine parts written by append into the results and parameter
+    # tables of an experiment. Rows are kept in the order of the parts.
+
+    df = pd.concat([pd.read_parquet(f) for f in parts], ignore_index=True)
+    results = df[COLUMNS]
+    params = df[METADATA].drop_duplicates('parameter')
+    params = params.reset_index(drop=True)
+    _write(results, os.path.join(path, RESULTS))
+    _write(params, os.path.join(path, PARAMETERS))
+
+
+def collect(path, parts, force=False):
+
+    # Combine the parts of an experiment and export the results as
+    # .dmr if requested (see dmr_export). Both steps are skipped if 
+    # their inputs have not changed.
+
+    stages.run(path, 'all_results', concat, parts, path, inputs=parts, 
+               force=force)
+    if dmr_export():
+        stages.run(path, 'all_results.dmr', to_dmr, path, 
+                   inputs=files(path), force=force)
+
+
+def read(path):
+
+    # Results of an experiment as a DataFrame with the columns
+    # subject, visit, parameter, value and sdev. Results that were
+    # only saved as all_results.dmr are read from there.
+
+    file = os.path.join(path, RESULTS)
+    if os.path.exists(file):
+        return pd.read_parquet(file)
+    dmr = pydmr.read(os.path.join(path, 'all_results'), format='table')
+    df = pd.DataFrame(dmr['pars'], columns=COLUMNS[:4])
+    sdev = pd.DataFrame(dmr['sdev'], columns=COLUMNS[:4])
+    df['sdev'] = sdev.value.values
+    return df
+
+
+def parameters(path):
+
+    # Metadata of the parameters of an experiment as a DataFrame with
+    # the columns parameter, description, unit, type, group and label.
+
+    file = os.path.join(path, PARAMETERS)
+    if os.path.exists(file):
+        return pd.read_parquet(file)
+    dmr = pydmr.read(os.path.join(path, 'all_results'), format='table')
+    return pd.DataFrame(dmr['data'], columns=METADATA)
+
+
+# Metadata tables of experiments read by metadata, by file
+_METADATA = {}
+
+
+def metadata(path):
+
+    # Metadata of the parameters of an experiment as in parameters, 
+    # but indexed by parameter. The table is only read once for each
+    # version of the results file - it is read again if the file has
+    # been modified since. The table is shared so must not be modified.
+
+    for file in [PARAMETERS, 'all_results.dmr', 'all_results.dmr.zip']:
+        file = os.path.join(path, file)
+        if os.path.exists(file):
+            break
+    stat = os.stat(file)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = _METADATA.get(file)
+    if cached is None or cached[0] != version:
+        df = parameters(path).set_index('parameter')
+        cached = _METADATA[file] = (version, df)
+    return cached[1]
+
+
+def lookup(path, params, prop):
+
+    # A property of the metadata (e.g. 'unit') for each parameter in 
+    # a list or array of parameters, in one vectorised lookup.
+
+    return metadata(path).loc[params, prop].tolist()
+
+
+def to_dmr(path):
+
+    # Export the results of an experiment as all_results.dmr
+
+    results = read(path)
+    params = parameters(path)
+    dmr = {
+        'data': {},
+        'pars': {},
+        'sdev': {},
+        'columns': ['group', 'label'],
+    }
+    for row in params.itertuples(index=False):
+        dmr['data'][row.parameter] = [
+            row.description, row.unit, row.type, row.group, row.label,
+        ]
+    for row in results.itertuples(index=False):
+        key = (row.subject, row.visit, row.parameter)
+        dmr['pars'][key] = row.value
+        dmr['sdev'][key] = row.sdev
+    file = os.path.join(path, 'all_results.dmr')
+    pydmr.write(file, dmr)
+    return file
+
+
+def files(path):
+    # Files of the store of an experiment
+    return [os.path.join(path, RESULTS), os.path.join(path, PARAMETERS)]
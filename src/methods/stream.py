@@ -0,0 +1,280 @@
+import os
+import csv
+import shutil
+import pickle
+import hashlib
+import zipfile
+from io import TextIOWrapper
+
+import numpy as np
+
+from methods import cache, stages
+
+
+# Streaming access to the subjects and visits of a .dmr file, so that
+# the data of a large cohort never need to be in memory at once.
+#
+# The signals in rois.csv are one column per subject, visit and roi,
+# so a single subject can only be read by reading the whole file.
+# The file is therefore converted once to memory-mapped arrays, one
+# column per roi in column-major order, and each record is read from
+# there when it is needed. The conversion reads rois.csv one block of
+# rows at a time. Only the scalar parameters of pars.csv are kept in
+# memory.
+#
+# The converted data are saved in the cache folder (see cache.folder)
+# and converted again when the .dmr file has changed.
+
+# Files of a converted dataset
+INDEX = 'index.pkl'
+VALUES = 'values.npy'
+PRESENT = 'present.npy'
+
+# Rows of rois.csv that are converted at once
+BLOCK = 1024
+
+
+def _zipfile(datafile):
+    # As in pydmr.read, extensions do not need to be included
+    if datafile.endswith('.dmr.zip'):
+        return datafile
+    if datafile.endswith('.dmr'):
+        return datafile + '.zip'
+    return datafile + '.dmr.zip'
+
+
+def folder(datafile):
+    # Location of the converted data of a .dmr file. The name depends
+    # on the size and modification time of the file so that a new
+    # version is converted again.
+    file = os.path.realpath(_zipfile(datafile))
+    stat = os.stat(file)
+    key = repr((file, stat.st_size, stat.st_mtime_ns))
+    key = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return os.path.join(cache.folder(), 'data', key)
+
+
+def _reader(z, name):
+    file = z.open(name)
+    return file, csv.reader(TextIOWrapper(file, encoding="utf-8"))
+
+
+def _read_data(z):
+    # Data dictionary as in pydmr.read: parameter: [description,
+    # unit, type, ...]
+    data = {}
+    file, reader = _reader(z, 'data.csv')
+    with file:
+        next(reader)
+        for d in reader:
+            data[d[0]] = d[1:]
+    return data
+
+
+def _value(value, data_type):
+    if data_type == 'str':
+        return value
+    if data_type == 'float':
+        return float(value)
+    if data_type == 'bool':
+        if value not in ['1', '0']:
+            raise ValueError(
+                f"Boolean value {value} is not allowed. Possible values "
+                "are 1 or 0. Correct the data in pars.csv"
+            )
+        return value == '1'
+    if data_type == 'int':
+        return int(value)
+    return complex(value)
+
+
+def _read_pars(z, data):
+    # Parameters nested by subject and visit, one row at a time
+    pars = {}
+    if 'pars.csv' not in z.namelist():
+        return pars
+    file, reader = _reader(z, 'pars.csv')
+    with file:
+        next(reader)
+        for p in reader:
+            if len(p) != 4:
+                raise ValueError(
+                    f"Error in pars row {p}. Each row must have 4 "
+                    "elements: subject, study, parameter, value. Correct "
+                    "the data in pars.csv"
+                )
+            if p[2] not in data:
+                raise ValueError(
+                    f"parameter {p[2]} is not listed in the data "
+                    "dictionary in data.csv"
+                )
+            value = _value(p[3], data[p[2]][2])
+            pars.setdefault(p[0], {}).setdefault(p[1], {})[p[2]] = value
+    return pars
+
+
+def _convert_rois(z, data, path):
+
+    # Convert rois.csv to two arrays with one column per roi: the
+    # values, and whether a value is present. Returns the headers
+    # (subject, study, roi) of the columns.
+
+    # First pass: headers and number of rows
+    file, reader = _reader(z, 'rois.csv')
+    with file:
+        headers = [next(reader) for _ in range(3)]
+        nrows = sum(1 for _ in reader)
+    headers = list(zip(*headers))
+    for h in headers:
+        if h[2] not in data:
+            raise ValueError(
+                f"roi parameter {h[2]} is not listed in the data "
+                "dictionary in data.csv. Please update the dictionary."
+            )
+        if data[h[2]][2] not in ['float', 'bool', 'int']:
+            raise ValueError(
+                f"roi parameter {h[2]} has type {data[h[2]][2]}. Only "
+                "numerical rois can be streamed."
+            )
+    shape = (nrows, len(headers))
+    values = np.lib.format.open_memmap(
+        os.path.join(path, VALUES), mode='w+', dtype=np.float64,
+        shape=shape, fortran_order=True)
+    present = np.lib.format.open_memmap(
+        os.path.join(path, PRESENT), mode='w+', dtype=bool,
+        shape=shape, fortran_order=True)
+
+    # Second pass: values, one block of rows at a time
+    file, reader = _reader(z, 'rois.csv')
+    with file:
+        for _ in range(3):
+            next(reader)
+        for start in range(0, nrows, BLOCK):
+            stop = min(start + BLOCK, nrows)
+            block = np.zeros((stop - start, len(headers)))
+            mask = np.zeros((stop - start, len(headers)), dtype=bool)
+            for i in range(stop - start):
+                row = next(reader)
+                for j, val in enumerate(row[:len(headers)]):
+                    if val:
+                        block[i, j] = float(val)
+                        mask[i, j] = True
+            values[start:stop] = block
+            present[start:stop] = mask
+    values.flush()
+    present.flush()
+    return headers
+
+
+def convert(datafile, path):
+
+    # Convert a .dmr file to the arrays and index read by Dataset
+
+    tmp = path + '.' + str(os.getpid()) + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    with zipfile.ZipFile(_zipfile(datafile), 'r') as z:
+        if 'data.csv' not in z.namelist():
+            raise ValueError("A .dmr file must contain a data.csv file.")
+        data = _read_data(z)
+        pars = _read_pars(z, data)
+        headers = []
+        if 'rois.csv' in z.namelist():
+            headers = _convert_rois(z, data, tmp)
+
+    # Columns of each record, in the order of pydmr.read with
+    # format='nest': subjects and their visits in order of appearance.
+    columns = {}
+    for j, (subj, visit, roi) in enumerate(headers):
+        columns.setdefault(subj, {}).setdefault(visit, []).append((roi, j))
+    index = {'data': data, 'pars': pars, 'columns': columns}
+    dataset = Dataset(tmp, index)
+    index['fingerprints'] = {
+        key: stages.fingerprint(dataset.subset(*key))
+        for key in dataset.keys()
+    }
+    with open(os.path.join(tmp, INDEX), 'wb') as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # Replace any earlier version in one step
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    return path
+
+
+def dataset(datafile):
+    # Streaming access to a .dmr file, which is converted first if
+    # this has not been done before.
+    path = folder(datafile)
+    if not os.path.exists(os.path.join(path, INDEX)):
+        print('Converting ', datafile, ' for streaming')
+        convert(datafile, path)
+    return Dataset(path)
+
+
+def records(datafile):
+    # Iterate over the (subject, visit, rois, pars) of a .dmr file,
+    # one record in memory at a time.
+    return iter(dataset(datafile))
+
+
+class Dataset:
+
+    # Data of a .dmr file converted by convert. Only the paths are
+    # sent to worker processes, which then read their own records.
+
+    def __init__(self, path, index=None):
+        self.path = path
+        self._index = index
+
+    def __repr__(self):
+        return 'Dataset(' + repr(self.path) + ')'
+
+    def __getstate__(self):
+        return {'path': self.path, '_index': None}
+
+    def index(self):
+        if self._index is None:
+            with open(os.path.join(self.path, INDEX), 'rb') as f:
+                self._index = pickle.load(f)
+        return self._index
+
+    def keys(self):
+        # (subject, visit) of all records
+        columns = self.index()['columns']
+        return [(subj, visit) for subj in columns for visit in columns[subj]]
+
+    def fingerprint(self, subj, visit):
+        # Hash of the data of a record (see stages.fingerprint)
+        return self.index()['fingerprints'][subj, visit]
+
+    def rois(self, subj, visit):
+        # Signals of a record as in pydmr.read: missing values are
+        # left out of each column.
+        index = self.index()
+        values = np.load(os.path.join(self.path, VALUES), mmap_mode='r')
+        present = np.load(os.path.join(self.path, PRESENT), mmap_mode='r')
+        rois = {}
+        for roi, j in index['columns'][subj][visit]:
+            col = np.asarray(values[:, j])[np.asarray(present[:, j])]
+            data_type = index['data'][roi][2]
+            if data_type == 'float':
+                rois[roi] = col
+            else:
+                rois[roi] = col.astype(np.dtype(data_type))
+        return rois
+
+    def pars(self, subj, visit):
+        return self.index()['pars'][subj][visit]
+
+    def subset(self, subj, visit):
+        # Data of a single subject and visit, as in tools.subset
+        return {
+            'rois': {subj: {visit: self.rois(subj, visit)}},
+            'pars': {subj: {visit: self.pars(subj, visit)}},
+        }
+
+    def __iter__(self):
+        for subj, visit in self.keys():
+            yield subj, visit, self.rois(subj, visit), self.pars(subj, visit)
@@ -2,87 +2,77 @@ import os
 import pandas as pd
 import numpy as np
 
-from methods import calc
+from methods import session as results_session
 
 
 
-def cases(folder):
+def cases(folder, session=None, combined=False):
+
+    # Tables of each subject, for liver and aorta, with the values in
+    # each visit and the change. Tables are slices of one pivot over 
+    # all subjects. If combined=True, the pivot is also saved as one
+    # table cases.csv with all subjects.
 
     path = os.path.join(folder, 'Tables')
     if not os.path.exists(path):
         os.makedirs(path)
         
     # Get data
-    df = pd.read_csv(
-        os.path.join(folder, 'Analysis', 'parameters_rep.csv')
-    )
-    src = os.path.join(folder)
-    df['group'] = calc.lookup(src, df.parameter.values, 'group')
-    df['description'] = calc.lookup(src, df.parameter.values, 'description')
-    df['unit'] = calc.lookup(src, df.parameter.values, 'unit') 
+    session = results_session.get(folder, session)
+    df = session.table('parameters_rep')
 
     # Get effect sizes
-    ef = pd.read_csv(
-        os.path.join(folder, 'Analysis', 'effect_size.csv')
-    )
-    ef['group'] = calc.lookup(src, ef.parameter.values, 'group')
-    ef['description'] = calc.lookup(src, ef.parameter.values, 'description')
+    ef = session.table('effect_size')
     ef['visit'] = 'change (%)'
-    ef['unit'] = calc.lookup(src, ef.parameter.values, 'unit')
-    ef['stdev'] = np.nan
 
     # Concatenate
-    ef = ef[['subject','visit','parameter','description','value','unit','stdev','group']]
-    df = df[['subject','visit','parameter','description','value','unit','stdev','group']]
-    df = pd.concat([df, ef])
-    dfa = df[df.group=='MRI - aorta']
-    df = df[df.group=='MRI - liver']
-
-    for i, subject in enumerate(df.subject.unique()):
-
+    cols = ['subject','visit','parameter','value']
+    df = pd.concat([df[cols], ef[cols]])
+    df['group'] = session.lookup(df.parameter.values, 'group')
+    df['description'] = session.lookup(df.parameter.values, 'description')
+    df['unit'] = session.lookup(df.parameter.values, 'unit') 
+
+    # One pivot for all subjects
+    pivot = pd.pivot_table(df, values='value', columns='visit', 
+                           index=['group','subject','description','unit'])
+    visits = ['control', 'drug', 'change (%)']
+
+    for (group, subject), table in pivot.groupby(level=['group','subject'], 
+                                                 sort=False):
         subj = str(subject).zfill(3)
-        dfs = df[df.subject==subject]
-        dfas = dfa[dfa.subject==subject]
-        
-        # Liver values
-        pivot = pd.pivot_table(dfs, values='value', columns='visit', 
-                                index=['description','unit'])
-        cols = pivot.columns.tolist()
-        if len(cols)>1:
-            pivot = pivot[['control', 'drug', 'change (%)']]
-        header = ['Biomarker', 'Units'] + list(pivot.columns)
-        table = []
-        for row in pivot.index:
-            rvals = list(np.around(pivot.loc[row,:].values,2))
-            table.append([row[0], row[1]] + rvals)
-        file = os.path.join(path, subj+'_liver.csv')
-        pd.DataFrame(table, columns=header).to_csv(file, index=False)
-
-        # Aorta values
-        pivot = pd.pivot_table(dfas, values='value', columns='visit', 
-                                index=['description','unit'])
-        cols = pivot.columns.tolist()
-        if len(cols)>1:
-            pivot = pivot[['control', 'drug', 'change (%)']]
-        header = ['Biomarker', 'Units'] + list(pivot.columns)
-        table = []
-        for row in pivot.index:
-            rvals = list(np.around(pivot.loc[row,:].values,2))
-            table.append([row[0], row[1]] + rvals)
-        file = os.path.join(path, subj+'_aorta.csv')
-        pd.DataFrame(table, columns=header).to_csv(file, index=False)
-
-
-def reference(folder):
+        table = table.droplevel(['group','subject'])
+        table = table.dropna(axis=1, how='all')
+        if len(table.columns)>1:
+            table = table[visits]
+        table = table.round(2).reset_index()
+        table = table.rename(columns={'description':'Biomarker', 'unit':'Units'})
+        table.columns.name = None
+        organ = group[len('MRI - '):]
+        file = os.path.join(path, subj + '_' + organ + '.csv')
+        table.to_csv(file, index=False)
+
+    if combined:
+        table = pivot[[v for v in visits if v in pivot.columns]]
+        table = table.round(2).reset_index()
+        table = table.rename(columns={
+            'group': 'Group', 'subject': 'Subject', 
+            'description': 'Biomarker', 'unit': 'Units',
+        })
+        table.columns.name = None
+        table.to_csv(os.path.join(path, 'cases.csv'), index=False)
+
+
+def reference(folder, session=None):
 
     path = os.path.join(folder, 'Tables')
     if not os.path.exists(path):#
         os.makedirs(path)
 
+    session = results_session.get(folder, session)
     for visit in ['control', 'drug']:
         for group in ['aorta', 'liver']:
-            file = os.path.join(folder, 'Analysis', 'difference_with_reference.csv')
-            df = pd.read_csv(file).set_index('Biomarker')
+            df = session.table('difference_with_reference')
+            df = df.set_index('Biomarker')
             df = df[df.visit==visit]
             df = df[df.group=='MRI - '+group]
             df.drop(columns=['visit','group'], inplace=True)
@@ -94,29 +84,28 @@ def reference(folder):
             pd.DataFrame(table, columns=header).to_csv(file, index=False)
 
 
-def averages(folder):
+def averages(folder, session=None):
 
     path = os.path.join(folder, 'Tables')
     if not os.path.exists(path):
         os.makedirs(path)
 
-    data = pd.read_csv(os.path.join(folder, 'Analysis', 'avr_95CI.csv'))
-    b_avr = data['mean control'].values
-    r_avr = data['mean drug'].values
-    c_avr = data['mean effect'].values
-    b_err = data['95%CI control'].values
-    r_err = data['95%CI drug'].values
-    c_err = data['95%CI effect'].values
+    session = results_session.get(folder, session)
+    data = session.table('avr_95CI')
 
     # Update output array
-    data['control'] = [str(b_avr[i]) + ' (' + str(b_err[i]) + ') ' 
-                         for i in range(b_avr.size)]
-    data['drug'] = [str(r_avr[i]) + ' (' + str(r_err[i]) + ') ' 
-                         for i in range(r_avr.size)]
-    data['change (%)'] = [str(c_avr[i]) + ' (' + str(c_err[i]) + ') ' 
-                            for i in range(c_avr.size)]
+    for col, name in [('control', 'control'), ('drug', 'drug'), 
+                      ('effect', 'change (%)')]:
+        data[name] = (data['mean ' + col].astype(str) + ' (' 
+                      + data['95%CI ' + col].astype(str) + ') ')
     
-    data = data[['description','group','unit', 'control', 'drug', 'change (%)']]
+    columns = ['description','group','unit', 'control', 'drug', 'change (%)']
+    if 'bootstrap 95%CI effect low' in data:
+        data['change (%) bootstrap 95%CI'] = (
+            '[' + data['bootstrap 95%CI effect low'].astype(str) + ', ' 
+            + data['bootstrap 95%CI effect high'].astype(str) + ']')
+        columns.append('change (%) bootstrap 95%CI')
+    data = data[columns]
     data = data.rename(columns={'description': "Biomarker", "unit": "Units"})
 
     liver = data[data.group=='MRI - liver']
@@ -131,13 +120,14 @@ def averages(folder):
 
 
 
-def pairwise_stats(folder):
+def pairwise_stats(folder, session=None):
 
     path = os.path.join(folder, 'Tables')
     if not os.path.exists(path):
         os.makedirs(path)
 
-    output = pd.read_csv(os.path.join(folder, 'Analysis', '_output_ttest.csv'))
+    session = results_session.get(folder, session)
+    output = session.table('_output_ttest')
 
     output.drop(columns=['Contrast', 'A', 'B', 'Paired', 'Parametric', 'T', 
                          'dof', 'alternative'], inplace=True)
@@ -1,8 +1,8 @@
 import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
 
-import numpy as np
-
-import pydmr
+from methods import metrics
 
 
 AORTA_PARS = ['RE_Sb', 'RE_R1b', 'S02a', 'BAT','CO','Thl','Dhl',
@@ -64,80 +64,18 @@ LABEL = {
 }
 
 
-def export_params(model, tb, Sb, tl, Sl, params):
-
-     # Compute AUC over 3hrs
-    model.tmax = model.BAT+180*60
-    t, cb, Cl = model.conc()
-    t, R1b, R1l = model.relax()
-    AUC_Cb = np.trapezoid(cb, model.t) 
-    AUC_Cl = np.trapezoid(Cl, t)
+def export_params(model, tb, Sb, tl, Sl, params, names=None):
 
-    # Compute relative enhancement at 20mins
-    tRE = model.BAT + 20*60
-    RE_R1b = (R1b[t<tRE][-1] - R1b[0])/R1b[0]
-    RE_R1l = (R1l[t<tRE][-1] - R1l[0])/R1l[0]
-    S0b = np.mean(Sb[tb<model.BAT-30])
-    S0l = np.mean(Sl[tl<model.BAT-30])
-    RE_Sb = (Sb[tb<tRE][-1] - S0b)/S0b
-    RE_Sl = (Sl[tl<tRE][-1] - S0l)/S0l
-
-    # Compute AUC over 35min
-    model.tmax = model.BAT+35*60
-    t, cb, Cl = model.conc()
-    t, R1b, R1l = model.relax()
-    AUC35_Cb = np.trapezoid(cb, model.t) 
-    AUC35_Cl = np.trapezoid(Cl, t) 
+    # Parameters of a trained model and the derived biomarkers 
+    # registered in metrics.BIOMARKERS (or those listed in names).
+    # tb, Sb and tl, Sl are the measured aorta and liver signals, and
+    # params the measured parameters.
+    biomarkers = metrics.evaluate(model, tb, Sb, tl, Sl, params, 
+                                  names=names)
 
     pars = model.export_params()
-    pars['AUC_Cb']=['AUC for Cb (0-inf)', 1000*AUC_Cb, 'mM*sec',0]
-    pars['AUC_Cl']=['AUC for Cl (0-inf)', 1000*AUC_Cl, 'mM*sec',0]  
-    pars['AUC35_Cb']=['AUC for Cb (0-35min)', 1000*AUC35_Cb, 'mM*sec',0]
-    pars['AUC35_Cl']=['AUC for Cl (0-35min)', 1000*AUC35_Cl, 'mM*sec',0]  
-    pars['RE_R1b']=['RE for R1b at 20min', 100*RE_R1b, '%',0]
-    pars['RE_R1l']=['RE for R1l at 20min', 100*RE_R1l, '%',0]
-    pars['RE_Sb']=['RE for Sb at 20min', 100*RE_Sb, '%',0]
-    pars['RE_Sl']=['RE for Sl at 20min', 100*RE_Sl, '%',0]     
-
-    # MOLLI values     
-    pars['T1_1']=['Liver T1-MOLLI at baseline', params['T1_liver_1'], 'sec', 0]
-    pars['T1_2']=['Liver T1-MOLLI at 45min', params['T1_liver_2'], 'sec', 0]
-
-    # Timings needed for plotting etc
-    pars['t1_MOLLI']=['Time of T1-MOLLI at baseline', params['T1_time_1']/(60*60), 'hrs', 0]
-    pars['t2_MOLLI']=['Time of T1-MOLLI at 45min', params['T1_time_2']/(60*60), 'hrs', 0]
-  
-    return pars  
-
-
-
-def to_dmr(path, subj, study, pars):
-
-    # Build data dictionary
-    dmr = {
-        'data': {},
-        'pars': {},   
-        'sdev': {},
-        'columns': ['group', 'label'],
-    }
-    for key, val in pars.items():
-        dmr['data'][key] = [val[0], val[2], 'float']
-        dmr['pars'][subj, study, key] = val[1]
-        dmr['sdev'][subj, study, key] = val[3]
-
-    # Append group and label to the data dictionary
-    for p in dmr['data']:
-        if p in AORTA_PARS:
-            dmr['data'][p].append('MRI - aorta')
-        else:
-            dmr['data'][p].append('MRI - liver')
-        dmr['data'][p].append(LABEL[p])
-
-    # Save as dmr file
-    name = subj + '_' + study
-    file = os.path.join(path, name + '.dmr')
-    pydmr.write(file, dmr)
-    return file
+    pars.update(biomarkers)
+    return pars
 
 
 
@@ -162,3 +100,77 @@ def to_tristan_units(pars):
     return pars
 
 
+def workers(n=None):
+    # Number of processes used for the per-subject calculations. If 
+    # not provided, this is read from the environment variable 
+    # TRISTAN_WORKERS (default 1). Values <= 0 use all available cores.
+    if n is None:
+        n = int(os.environ.get('TRISTAN_WORKERS', 1))
+    if n <= 0:
+        n = os.cpu_count()
+    return n
+
+
+def plot_workers(n=None):
+    # Number of processes used for the per-subject plots. If not 
+    # provided, this is read from the environment variable 
+    # TRISTAN_PLOT_WORKERS, falling back to the number of workers
+    # used for the calculations.
+    if n is None:
+        n = os.environ.get('TRISTAN_PLOT_WORKERS')
+        n = None if n in [None, ''] else int(n)
+    return workers(n)
+
+
+# Per-subject plots: all windows, key plot only (the full time 
+# course shown in the reports), or none.
+PLOT_MODES = ['all', 'key', 'off']
+
+
+def plot_mode(mode=None):
+    # If not provided, the plot mode is read from the environment
+    # variable TRISTAN_PLOTS (default 'all').
+    if mode is None:
+        mode = os.environ.get('TRISTAN_PLOTS', 'all')
+    if mode not in PLOT_MODES:
+        raise ValueError(
+            f"Plot mode {mode} is not recognised. Options are {PLOT_MODES}."
+        )
+    return mode
+
+
+def pmap(func, tasks, n=None):
+    # Apply func to each tuple of arguments in tasks, using a process 
+    # pool if more than one worker is requested. Results are returned 
+    # in the order of the tasks regardless of completion order.
+    n = min(workers(n), max(len(tasks), 1))
+    if n == 1:
+        return [func(*args) for args in tasks]
+    with ProcessPoolExecutor(max_workers=n) as pool:
+        futures = [pool.submit(func, *args) for args in tasks]
+        return [future.result() for future in futures]
+
+
+def subset(data, subj, visit):
+    # Extract the data of a single subject and visit, so that only 
+    # these need to be sent to a worker process.
+    return {
+        'rois': {subj: {visit: data['rois'][subj][visit]}},
+        'pars': {subj: {visit: data['pars'][subj][visit]}},
+    }
+
+
+def peak_memory():
+    # Peak resident memory (MB) of this process and of its child 
+    # processes, or None where this is not available (Windows).
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = [
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    ]
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    scale = 1e6 if sys.platform == 'darwin' else 1e3
+    return max(usage) / scale
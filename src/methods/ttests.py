@@ -0,0 +1,203 @@
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+import pingouin as pg
+
+
+# T-tests for many parameters at once. Each column of the arrays x and
+# y holds the values of one test, padded with NaN where groups have
+# different sizes. Results are the same as those of pingouin, with one
+# row per column and the same columns. Only two-sided tests are used.
+
+ENGINES = ['numpy', 'pingouin', 'verify']
+
+
+def engine(name=None):
+    # If not provided, the engine is read from the environment variable
+    # TRISTAN_STATS (default 'numpy'). 'pingouin' runs one pingouin
+    # test per parameter, and 'verify' runs both and checks that the
+    # results agree.
+    if name is None:
+        name = os.environ.get('TRISTAN_STATS', 'numpy')
+    if name not in ENGINES:
+        raise ValueError(
+            f"Statistics engine {name} is not recognised. Options are "
+            f"{ENGINES}."
+        )
+    return name
+
+
+def _moments(x):
+    # Number of values, mean and unbiased variance of each column,
+    # ignoring NaN. Columns with too few values return NaN.
+    n = np.sum(~np.isnan(x), axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.nansum(x, axis=0)/n
+        var = np.nansum((x - mean)**2, axis=0)/(n - 1)
+    return n, mean, var
+
+
+def _power(d, dof, nc):
+    # Power of a two-sided test at alpha = 0.05 (pg.power_ttest)
+    tcrit = stats.t.ppf(0.975, dof)
+    nc = np.abs(d)*nc
+    return stats.nct.sf(tcrit, dof, nc) + stats.nct.cdf(-tcrit, dof, nc)
+
+
+def _format_bf(bf):
+    # Format of the Bayes Factors in pingouin tables
+    if bf >= 1e4 or bf <= 1e-4:
+        return np.format_float_scientific(bf, precision=3, trim='0')
+    return np.format_float_positional(bf, precision=3, trim='0')
+
+
+def _bayes_factor(T, nx, ny, paired):
+    # The JZS Bayes Factor is an integral that is evaluated for each
+    # test separately.
+    bf = [
+        pg.bayesfactor_ttest(float(t), int(a), int(b), paired=paired)
+        for t, a, b in zip(T, nx, ny)
+    ]
+    return [_format_bf(b) for b in bf]
+
+
+def _paired(x, y):
+    # Paired test of each column with listwise deletion of missing
+    # values (pg.ttest with paired=True).
+    pairs = ~np.isnan(x) & ~np.isnan(y)
+    x = np.where(pairs, x, np.nan)
+    y = np.where(pairs, y, np.nan)
+    n, mdiff, vdiff = _moments(x - y)
+    _, mx, vx = _moments(x)
+    _, my, vy = _moments(y)
+    dof = n - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        se = np.sqrt(vdiff/n)
+        T = mdiff/se
+        d = (mx - my)/np.sqrt((vx + vy)/2)
+        nc = np.sqrt(n)
+    # No test if the values are the same
+    T[np.all(~pairs | (x == y), axis=0)] = np.nan
+    return {
+        'n': n, 'T': T, 'dof': dof, 'se': se, 'd': d, 'nc': nc,
+        'ny': n, 'offset': 0,
+    }
+
+
+def _unpaired(x, y):
+    # Unpaired test of each column (pg.ttest with correction='auto').
+    # Welch's test is used when the groups have different sizes, and a
+    # one-sample test against y when y has only one value.
+    nx, mx, vx = _moments(x)
+    ny, my, vy = _moments(y)
+    welch = nx != ny
+    one = ny == 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Student
+        dof = (nx + ny - 2).astype(float)
+        pooled = ((nx - 1)*vx + (ny - 1)*vy)/dof
+        se = np.sqrt(pooled*(1/nx + 1/ny))
+        # Welch
+        a, b = vx/nx, vy/ny
+        welch_dof = (a + b)**2/(a**2/(nx - 1) + b**2/(ny - 1))
+        # As in scipy, for groups without variance
+        welch_dof = np.where(np.isnan(welch_dof), 1, welch_dof)
+        dof = np.where(welch, welch_dof, dof)
+        se = np.where(welch, np.sqrt(a + b), se)
+        # One sample
+        dof = np.where(one, nx - 1, dof)
+        se = np.where(one, np.sqrt(vx/nx), se)
+        T = (mx - my)/se
+        d = np.where(one, (mx - my)/np.sqrt(vx), (mx - my)/np.sqrt(pooled))
+        power_dof = np.where(one, nx - 1, nx + ny - 2)
+        nc = np.where(one, np.sqrt(nx), 1/np.sqrt(1/nx + 1/ny))
+    return {
+        'n': nx, 'T': T, 'dof': dof, 'se': se, 'd': d, 'nc': nc,
+        'power_dof': power_dof, 'ny': ny, 'offset': np.where(one, my, 0),
+    }
+
+
+def ttest(x, y, paired=False, confidence=0.95):
+
+    # T-test of each column of x against the same column of y, with
+    # the columns of pg.ttest.
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    r = _paired(x, y) if paired else _unpaired(x, y)
+    T, dof = r['T'], r['dof']
+    p = 2*stats.t.sf(np.abs(T), dof)
+    tcrit = stats.t.ppf(1 - (1 - confidence)/2, dof)
+    ci = np.stack([T - tcrit, T + tcrit])*r['se'] + r['offset']
+    # Confidence intervals are rounded as in pingouin tables
+    ci = np.round(ci, 2)
+    power_dof = r.get('power_dof', r['n'] - 1)
+    ci_name = 'CI%.0f%%' % (100*confidence)
+    return pd.DataFrame({
+        'T': T,
+        'dof': dof,
+        'alternative': 'two-sided',
+        'p-val': p,
+        ci_name: list(ci.T),
+        'cohen-d': np.abs(r['d']),
+        'BF10': _bayes_factor(T, r['n'], r['ny'], paired),
+        'power': _power(r['d'], power_dof, r['nc']),
+    })
+
+
+def pairwise_tests(x, y, contrast, A, B):
+
+    # Paired t-test between two levels A and B of a within-subject
+    # factor contrast for each column, with odds ratios as effect
+    # sizes. The columns are those of pg.pairwise_tests with
+    # return_desc=False and effsize='odds-ratio'. x are the values
+    # for A and y for B, with one row per subject.
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    r = _paired(x, y)
+    return pd.DataFrame({
+        'Contrast': contrast,
+        'A': A,
+        'B': B,
+        'Paired': True,
+        'Parametric': True,
+        'T': r['T'],
+        'dof': r['dof'].astype(float),
+        'alternative': 'two-sided',
+        'p-unc': 2*stats.t.sf(np.abs(r['T']), r['dof']),
+        'BF10': _bayes_factor(r['T'], r['n'], r['n'], True),
+        'odds-ratio': np.exp(r['d']*np.pi/np.sqrt(3)),
+    })
+
+
+def verify(result, reference, rtol=1e-6):
+    # Check results against those computed with pingouin. Bayes
+    # Factors are compared as numbers as their last printed digit can
+    # differ.
+    if list(result.columns) != list(reference.columns):
+        raise ValueError(
+            f"Columns {list(result.columns)} differ from those of "
+            f"pingouin {list(reference.columns)}."
+        )
+    for col in result.columns:
+        a, b = result[col].values, reference[col].values
+        if col == 'BF10':
+            a, b = a.astype(float), b.astype(float)
+            ok = np.allclose(a, b, rtol=1e-2, equal_nan=True)
+        elif a.dtype.kind == 'f' or b.dtype.kind == 'f':
+            ok = np.allclose(a.astype(float), b.astype(float), rtol=rtol,
+                             equal_nan=True)
+        elif len(a) > 0 and isinstance(a[0], np.ndarray):
+            # Confidence intervals, rounded to 2 decimals
+            ok = np.allclose(np.stack(a), np.stack(b), atol=0.011,
+                             equal_nan=True)
+        else:
+            ok = np.array_equal(a, b)
+        if not ok:
+            raise ValueError(
+                f"Column {col} differs from pingouin: {a} != {b}"
+            )
+    print('Statistics verified against pingouin: ', len(result), ' tests')
@@ -2,36 +2,143 @@ import os
 import time
 
 import dcmri as dc
-import pydmr
 
-from methods import tools
+from methods import tools, stages, plot, store, stream, metrics
+from methods import cache as fit_cache
 
 
-def compute(datafile, resultspath):
+def compute(datafile, resultspath, workers=None, cache=None, force=False):
 
     start = time.time()
 
     if not os.path.exists(resultspath):
         os.makedirs(resultspath)
 
-    results = []
-    data = pydmr.read(datafile, format='nest')
-    for subj in data['rois'].keys():
-        for visit in data['rois'][subj].keys():
-            
-            # Train model
-            model = subject_model(data, subj, visit, verbose=2)
+    data = stream.dataset(datafile)
+    verbose = 2 if tools.workers(workers) == 1 else 0
+    tasks, names, inputs = [], [], []
+    for subj, visit in data.keys():
+        tasks.append((data, subj, visit, resultspath, verbose, 
+                      cache))
+        names.append('fit ' + subj + ' ' + visit)
+        inputs.append([data.fingerprint(subj, visit), 
+                       stages.source(tools, metrics)])
+
+    # Train models and save results, skipping those that are up to date
+    results = stages.pmap(resultspath, _compute_subject, tasks, names, 
+                          inputs, workers, force)
+    results = [file for files in results for file in files 
+               if file.endswith('.parquet')]
+    store.collect(resultspath, results, force=force)
 
-            # Save results
-            save_plots(model, data, subj, visit, resultspath)
-            file = save_results(model, data, subj, visit, resultspath)
+    print('Calculation time (mins): ', (time.time()-start)/60)
 
-            results.append(file)
 
-    file = os.path.join(resultspath, 'all_results')
-    pydmr.concat(results, file)
+def plots(datafile, resultspath, workers=None, mode=None, windows=None, 
+          budget=None, force=False):
 
-    print('Calculation time (mins): ', (time.time()-start)/60)
+    # Plot the fits saved by compute. Plots run in their own process 
+    # pool (see tools.plot_workers) and the mode 'all', 'key' or 'off' 
+    # selects which plots are made (see tools.plot_mode). windows 
+    # overrides the default plot windows (see plot.WINDOWS). The 
+    # report variants of the key plots share the size budget in MB 
+    # (see plot.report_budget).
+
+    mode = tools.plot_mode(mode)
+    if mode == 'off':
+        return
+    
+    start = time.time()
+
+    data = stream.dataset(datafile)
+    keys = data.keys()
+    budget = 1e6*plot.report_budget(budget)/max(len(keys), 1)
+    tasks, names, inputs = [], [], []
+    for subj, visit in keys:
+        tasks.append((data, subj, visit, resultspath, mode, 
+                      windows, budget))
+        names.append('plot ' + subj + ' ' + visit)
+        inputs.append([fit_file(resultspath, subj, visit), 
+                       data.fingerprint(subj, visit), mode, windows, 
+                       budget, stages.source(plot)])
+
+    # Create plots, skipping those that are up to date
+    stages.pmap(resultspath, _plot_subject, tasks, names, inputs, 
+                tools.plot_workers(workers), force)
+
+    print('Plotting time (mins): ', (time.time()-start)/60)
+
+
+def biomarkers(datafile, resultspath, names=None, workers=None):
+
+    # Compute biomarkers registered in metrics.BIOMARKERS (all or
+    # those listed in names) from the fits saved by compute, without 
+    # training the models again (see onescan.biomarkers).
+
+    start = time.time()
+
+    data = stream.dataset(datafile)
+    tasks = [
+        (data, subj, visit, resultspath, names) 
+        for subj, visit in data.keys()
+    ]
+    results = tools.pmap(_biomarkers_subject, tasks, workers)
+    store.collect(resultspath, results)
+
+    print('Biomarker time (mins): ', (time.time()-start)/60)
+
+
+def _biomarkers_subject(dataset, subj, visit, resultspath, names=None):
+
+    # Restore the trained model saved by compute
+    data = dataset.subset(subj, visit)
+    rois = data['rois'][subj][visit]
+    pars = data['pars'][subj][visit]
+    model = _model(rois, pars)
+    fit_cache.restore(model, fit_file(resultspath, subj, visit))
+
+    # Evaluate as in save_results
+    xdata, ydata = _data(rois)
+    tb, Sb, tl, Sl = xdata[0], ydata[0], xdata[2], ydata[2]
+    model.dose2 = 0
+    params = metrics.evaluate(model, tb, Sb, tl, Sl, pars, names=names)
+    params = tools.to_tristan_units(params)
+
+    resultspath = os.path.join(resultspath, 'Results')
+    return store.update(resultspath, subj, visit, params)
+
+
+def _plot_subject(dataset, subj, visit, resultspath, mode='all', 
+                  windows=None, budget=None):
+
+    # Restore the trained model saved by compute
+    data = dataset.subset(subj, visit)
+    rois = data['rois'][subj][visit]
+    pars = data['pars'][subj][visit]
+    model = _model(rois, pars)
+    fit_cache.restore(model, fit_file(resultspath, subj, visit))
+
+    return save_plots(model, data, subj, visit, resultspath, mode=mode, 
+                      windows=windows, budget=budget)
+
+
+def fit_file(path, subj, visit):
+    return os.path.join(path, 'Fits', subj + '_' + visit + '.pkl')
+
+
+def _compute_subject(dataset, subj, visit, resultspath, verbose=0, 
+                     cache=None):
+
+    # Read the data of this subject and visit only (see stream.Dataset)
+    data = dataset.subset(subj, visit)
+
+    # Train model
+    model = subject_model(data, subj, visit, verbose=verbose, cache=cache)
+
+    # Save the trained model for the plots, and the results. The 
+    # trained model is saved first as save_results modifies it.
+    fit = fit_cache.dump(model, fit_file(resultspath, subj, visit))
+    return [save_results(model, data, subj, visit, resultspath), fit]
 
 
 def _data(rois):
@@ -50,13 +157,9 @@ def _data(rois):
     return xdata, ydata
 
 
-def subject_model(data, subj, visit, verbose=0):
+def _model(rois, pars):
 
-    rois = data['rois'][subj][visit]
-    pars = data['pars'][subj][visit]
-
-    # Define default model
-    model = dc.AortaLiver2scan(
+    return dc.AortaLiver2scan(
 
         # Injection parameters
         weight=pars['weight'],
@@ -83,13 +186,32 @@ def subject_model(data, subj, visit, verbose=0):
         vol=pars['liver_volume'],
     )
 
+
+def subject_model(data, subj, visit, verbose=0, cache=None):
+
+    rois = data['rois'][subj][visit]
+    pars = data['pars'][subj][visit]
+
+    # Define default model
+    model = _model(rois, pars)
+
     # Personalise model
     xdata, ydata = _data(rois)
-    model.train(xdata, ydata, xtol=1e-3, verbose=verbose)
+    fit_cache.train(model, xdata, ydata, pars, cache=cache, 
+                    verbose=verbose, xtol=1e-3)
     return model
 
 
-def save_plots(model, data, subj, visit, path):
+def save_plots(model, data, subj, visit, path, mode='all', windows=None,
+               budget=None):
+
+    # If mode is 'key', only the plot of the full time course is made.
+    # Otherwise one plot is also made for each of the windows (see 
+    # plot.WINDOWS) after each of the two bolus injections. If a budget 
+    # (bytes) is given, a report variant of the full time course is 
+    # saved as well (see plot.fit).
+    if mode == 'off':
+        return []
 
     rois = data['rois'][subj][visit]
     pars = data['pars'][subj][visit]
@@ -116,8 +238,7 @@ def save_plots(model, data, subj, visit, path):
         1/pars['T1_liver_3'],
     ]
 
-    if not os.path.exists(path):
-        os.makedirs(path)
+    os.makedirs(path, exist_ok=True)
 
     ya = [dc.signal_ss(model.S0a, R1a[0], model.TR, model.FA),
           dc.signal_ss(model.S0a, R1a[1], model.TR, model.FA),
@@ -126,23 +247,14 @@ def save_plots(model, data, subj, visit, path):
           dc.signal_ss(model.S0l, R1l[1], model.TR, model.FA),
           dc.signal_ss(model.S02l, R1l[2], model.TR, model.FA)]
     test = ((t,ya),(t,yl))
-    model.plot(xdata, ydata, fname=file + '.png', ref=test, show=False)
-
-    BAT = model.BAT
-    model.plot(xdata, ydata, xlim=[BAT-20, BAT+1200], 
-               fname=file + '_scan1_win1.png', ref=test, show=False)
-    model.plot(xdata, ydata, xlim=[BAT-20, BAT+600], 
-               fname=file + '_scan1_win2.png', ref=test, show=False)
-    model.plot(xdata, ydata, xlim=[BAT-20, BAT+160], 
-               fname=file + '_scan1_win3.png', ref=test, show=False)
-    
-    BAT = model.BAT2
-    model.plot(xdata, ydata, xlim=[BAT-20, BAT+1200], 
-               fname=file + '_scan2_win1.png', ref=test, show=False)
-    model.plot(xdata, ydata, xlim=[BAT-20, BAT+600], 
-               fname=file + '_scan2_win2.png', ref=test, show=False)
-    model.plot(xdata, ydata, xlim=[BAT-20, BAT+160], 
-               fname=file + '_scan2_win3.png', ref=test, show=False)
+    xlims = {'': None}
+    if mode == 'all':
+        for w, xlim in plot.fit_windows(model.BAT, windows).items():
+            xlims['_scan1_' + w] = xlim
+        for w, xlim in plot.fit_windows(model.BAT2, windows).items():
+            xlims['_scan2_' + w] = xlim
+    return plot.fit(model, xdata, ydata, file, xlims, ref=test, 
+                    budget=budget)
 
 
 def save_results(model, data, subj, visit, path):
@@ -173,7 +285,7 @@ def save_results(model, data, subj, visit, path):
     params['dt2']=["Time step second acquisition", model.TS, 'sec',0]
 
     params = tools.to_tristan_units(params)
-    dmrpath = os.path.join(path, 'Results')
-    return tools.to_dmr(dmrpath, subj, visit, params)
+    resultspath = os.path.join(path, 'Results')
+    return store.append(resultspath, subj, visit, params)
 
 
@@ -1,15 +1,153 @@
 """
 Replicate all results from TRISTAN studies in humans.
+
+The studies are run at the same time as separate processes, sharing a
+global budget of CPU cores (--workers, default all cores) with the
+process pools inside each study. The output of each study is written
+to build/logs/<study>.log. A study that fails does not stop the others.
 """
 
-import tristan_controls
-import tristan_rifampicin
-import tristan_rifampicin_clinical
-import tristan_metformin
-import tristan_ciclosporin
-
-tristan_controls.main()
-tristan_rifampicin_clinical.main()
-tristan_rifampicin.main()
-tristan_metformin.main()
-tristan_ciclosporin.main()
+import os
+import sys
+import time
+import subprocess
+
+from methods import cli
+
+
+STUDIES = [
+    'tristan_controls',
+    'tristan_rifampicin_clinical',
+    'tristan_rifampicin',
+    'tristan_metformin',
+    'tristan_ciclosporin',
+]
+
+
+def _last_line(file):
+    # Last line written to a log file, as an indication of progress
+    with open(file, 'rb') as f:
+        try:
+            f.seek(-1024, os.SEEK_END)
+        except OSError:
+            f.seek(0)
+        lines = f.read().decode(errors='replace').splitlines()
+    lines = [l.strip() for l in lines if l.strip()]
+    return lines[-1][:80] if lines else ''
+
+
+def _share(value, workers):
+    # Number of workers in a setting, at most the share of the study
+    value = 0 if value in [None, ''] else int(value)
+    if value <= 0:
+        return workers
+    return min(value, workers)
+
+
+def _launch(study, workers, logpath):
+    # Each study gets its share of the CPU budget for its own process
+    # pools. The other options are passed on through the environment.
+    env = os.environ.copy()
+    env['TRISTAN_WORKERS'] = str(workers)
+    # Numbers of plot and report workers set by the user are capped 
+    # at the share (values <= 0 use all cores, see tools.workers).
+    for var in ['TRISTAN_PLOT_WORKERS', 'TRISTAN_REPORT_WORKERS']:
+        env[var] = str(_share(os.environ.get(var), workers))
+    # Avoid oversubscription by multithreaded numerical libraries
+    env.setdefault('OMP_NUM_THREADS', '1')
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          study + '.py')
+    log = open(os.path.join(logpath, study + '.log'), 'w')
+    proc = subprocess.Popen(
+        [sys.executable, '-u', script],
+        stdout=log, stderr=subprocess.STDOUT, env=env,
+    )
+    return proc, log
+
+
+def run(studies=STUDIES, budget=None, concurrent=None, interval=60):
+
+    # Run the studies with at most budget cores in use and at most
+    # concurrent studies at the same time. Each study that is started
+    # gets an equal share of the cores that are still free. Prints
+    # progress every interval seconds and a timing summary at the end.
+
+    if budget is None:
+        budget = os.cpu_count()
+    if concurrent is None:
+        concurrent = len(studies)
+    concurrent = max(1, min(concurrent, budget, len(studies)))
+
+    logpath = os.path.join(os.getcwd(), 'build', 'logs')
+    os.makedirs(logpath, exist_ok=True)
+
+    start = time.time()
+    pending = list(studies)
+    running = {}
+    summary = {}
+    last_report = time.time()
+    while pending or running:
+
+        # Start studies while there are free slots
+        while pending and len(running) < concurrent:
+            free = budget - sum(r['workers'] for r in running.values())
+            slots = min(concurrent - len(running), len(pending))
+            workers = max(1, free // slots)
+            study = pending.pop(0)
+            proc, log = _launch(study, workers, logpath)
+            running[study] = {
+                'proc': proc, 'log': log, 'workers': workers,
+                'start': time.time(),
+            }
+            print(f'[{study}] started with {workers} worker(s)')
+
+        # Collect finished studies
+        for study in list(running):
+            r = running[study]
+            code = r['proc'].poll()
+            if code is None:
+                continue
+            r['log'].close()
+            mins = (time.time() - r['start'])/60
+            status = 'done' if code == 0 else f'FAILED (exit code {code})'
+            summary[study] = (status, r['workers'], mins)
+            print(f'[{study}] {status} after {mins:.1f} min')
+            if code != 0:
+                print(f'[{study}] see ' + r['log'].name)
+            del running[study]
+
+        # Progress of the running studies
+        if running and time.time() - last_report > interval:
+            last_report = time.time()
+            for study, r in running.items():
+                mins = (time.time() - r['start'])/60
+                print(f'[{study}] running for {mins:.1f} min: '
+                      + _last_line(r['log'].name))
+
+        time.sleep(1)
+
+    # Timing summary
+    print('')
+    print(f"{'Study':<30}{'Status':<25}{'Workers':>8}{'Time (min)':>12}")
+    for study in studies:
+        status, workers, mins = summary[study]
+        print(f'{study:<30}{status:<25}{workers:>8}{mins:>12.1f}')
+    print('Total time (min): ', (time.time()-start)/60)
+
+    return [s for s in studies if summary[s][0] != 'done']
+
+
+if __name__ == '__main__':
+    parser = cli.options()
+    parser.add_argument(
+        '--studies', nargs='+', default=STUDIES, choices=STUDIES,
+        help='Studies to run (default: all).',
+    )
+    parser.add_argument(
+        '--concurrent', type=int, default=None,
+        help='Maximum number of studies running at the same time.',
+    )
+    args = cli.parse_args(parser=parser)
+    budget = None if not args.workers else args.workers
+    failed = run(args.studies, budget, args.concurrent)
+    sys.exit(1 if failed else 0)
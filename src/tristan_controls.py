@@ -1,37 +1,33 @@
 import os
-import shutil
 
-import miblab
-
-from methods import onescan, twoscan
+from methods import onescan, twoscan, datastore, cli
 
 
 def main():
 
     drug = 'controls'
     results = os.path.join(os.getcwd(), 'build', drug)
-    datapath = os.path.join(os.getcwd(), 'data')
 
-    data = miblab.zenodo_fetch(
-        f'tristan_humans_healthy_{drug}.dmr.zip', 
-        datapath,
-    )
+    data = datastore.fetch(f'tristan_humans_healthy_{drug}.dmr.zip')
 
     # One scan
     path = os.path.join(results, 'results (one scan)')
     onescan.compute(data, path)
+    onescan.plots(data, path)
 
     # Two scan
     path = os.path.join(results, 'results (two scans)')
     twoscan.compute(data, path)
+    twoscan.plots(data, path)
 
     # Variable time
     path = os.path.join(results, 'results (one scan - variable tacq)')
-    onescan.compute_vart(data, path)
-
-    shutil.rmtree(datapath)
+    acq_times = [5,10,15,20,25,30,35,40]
+    onescan.compute_vart(data, path, acq_times=acq_times)
+    onescan.plots(data, path, acq_times=acq_times)
 
 
 if __name__ == '__main__':
+    cli.parse_args()
     main()
 
@@ -0,0 +1,48 @@
+"""
+Manage the local data store (default: data in the working directory,
+or the folder in the environment variable TRISTAN_DATA).
+
+    python src/tristan_data.py list
+    python src/tristan_data.py fetch <dataset>
+    python src/tristan_data.py verify
+    python src/tristan_data.py purge [<dataset>]
+"""
+
+import os
+import argparse
+
+from methods import datastore
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['list', 'fetch', 'verify', 'purge'])
+    parser.add_argument('datasets', nargs='*')
+    args = parser.parse_args(argv)
+
+    if args.command == 'list':
+        print('Data store: ', datastore.folder())
+        for dataset in datastore.datasets():
+            print(dataset)
+
+    elif args.command == 'fetch':
+        for dataset in args.datasets:
+            print(datastore.fetch(dataset))
+
+    elif args.command == 'verify':
+        for dataset in args.datasets or datastore.datasets():
+            file = os.path.join(datastore.folder(), dataset)
+            datastore.verify(file, full=True)
+            print('OK: ', dataset)
+
+    elif args.command == 'purge':
+        if args.datasets:
+            for dataset in args.datasets:
+                datastore.purge(dataset)
+        else:
+            datastore.purge()
+
+
+if __name__ == '__main__':
+    main()
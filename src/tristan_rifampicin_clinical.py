@@ -1,21 +1,14 @@
 import os
-import shutil
 
-import miblab
-
-from methods import report, master
+from methods import report, master, datastore, cli
 
 
 def main():
 
     drug = 'rifampicin'
     results = os.path.join(os.getcwd(), 'build', f'{drug}_clinical')
-    datapath = os.path.join(os.getcwd(), 'data')
 
-    data = miblab.zenodo_fetch(
-        f'tristan_humans_patients_{drug}.dmr.zip', 
-        datapath,
-    )
+    data = datastore.fetch(f'tristan_humans_patients_{drug}.dmr.zip')
     master.run(
         data, 
         results, 
@@ -23,22 +16,24 @@ def main():
         ref=True,
         compute=True,
     )
-    report.all_results(
-        results, 
-        'report (complete)',
-        title = 'Gothenburg patient study',
-        subtitle = f'{drug} (all results)',
-        subject = 'D2.07 - Internal report',
-    )
-    report.key_results(
-        results, 
-        'report (summary)',
-        title = 'Gothenburg patient study',
-        subtitle = f'{drug} (key results)',
-        subject = 'D2.13 - Internal report',
-    )
-    shutil.rmtree(datapath)
+    report.build([
+        (report.all_results, dict(
+            resultspath = results,
+            filename = 'report (complete)',
+            title = 'Gothenburg patient study',
+            subtitle = f'{drug} (all results)',
+            subject = 'D2.07 - Internal report',
+        )),
+        (report.key_results, dict(
+            resultspath = results,
+            filename = 'report (summary)',
+            title = 'Gothenburg patient study',
+            subtitle = f'{drug} (key results)',
+            subject = 'D2.13 - Internal report',
+        )),
+    ])
 
     
 if __name__ == '__main__':
+    cli.parse_args()
     main()
\ No newline at end of file